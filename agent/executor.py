@@ -1,6 +1,7 @@
 import threading
 import time
 import inspect
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, List, Literal, Optional
 
 from .schema import Plan
@@ -12,6 +13,54 @@ from . import llm
 
 ReplanMode = Literal["never", "on_error"]
 
+# Инструменты, которые можно выполнять в пуле потоков.
+# acad.*-читалок здесь нет: AutoCAD — STA COM-сервер, и его интерфейсы
+# нельзя дёргать из worker-потоков без CoInitializeEx и маршалинга
+# указателей в каждый поток — каждый такой шаг падал бы с
+# CO_E_NOTINITIALIZED/RPC_E_WRONG_THREAD, сжигал все STEP_RETRIES и
+# уводил план в реплан, что строго хуже последовательного исполнения.
+# swmm.run_cli — обычный subprocess.run без COM и общего состояния:
+# несколько расчётов разных .inp спокойно идут бок о бок.
+_PARALLEL_SAFE: set = {"swmm.run_cli"}
+_MAX_PARALLEL_WORKERS = 4
+
+# TOOLS статичен, а inspect.signature дорог — считаем допустимые
+# параметры один раз на функцию
+_SIG_CACHE: Dict[Any, frozenset] = {}
+
+# Только эти reason действительно блокируют план; произвольный
+# информационный reason не повод дёргать LLM на реплан.
+_BLOCKING_REASONS = {
+    "no_entities",
+    "empty_model",
+    "no_closed_polylines",
+    "no_circles",
+    "no_squares",
+    "no_bbox",
+    "unknown_shape",
+    "find_squares_failed",
+}
+
+# контекстные читалки: пустая модель для них — штатная ситуация
+_OPTIONAL_CONTEXT_TOOLS = {
+    "acad.get_extents_of_model",
+    "acad.get_center_of_model",
+    "acad.snapshot_model",
+}
+
+# инструменты, меняющие модель: после них кэш наблюдений устаревает
+_MUTATING_PREFIXES = (
+    "acad.draw",
+    "acad.erase",
+    "acad.copy",
+    "acad.inscribe",
+    "acad.make",
+    "acad.save_as",
+)
+
+# сколько живёт кэш doc/extents между репланами
+_OBS_TTL = 0.5
+
 
 class Executor:
     """
@@ -41,8 +90,15 @@ class Executor:
         self.max_replans = max_replans
         self._replans_done = 0
 
+        # история ограничена: старые шаги схлопываются в сводку,
+        # иначе replan-контекст (и токены) растут без предела
+        self.history_cap = 50
+        self.history_squash = 25
         self.history: List[Dict[str, Any]] = []
 
+        # TTL-кэш наблюдений (doc/extents) для кучных репланов
+        self._obs_cache: Dict[str, Any] = {}
+
     # ------------------------------
     # Публичные методы
     # ------------------------------
@@ -70,11 +126,22 @@ class Executor:
                 self.report("⏹ Остановлено пользователем")
                 return False
 
+            # пачка из 2+ подряд идущих читающих шагов — выполняем параллельно
+            batch_end = step_idx
+            while batch_end < len(remaining) and remaining[batch_end].get("tool") in _PARALLEL_SAFE:
+                batch_end += 1
+            if batch_end - step_idx >= 2:
+                outcome = self._run_parallel_batch(plan.goal, remaining, step_idx, batch_end, steps_done)
+                if outcome is None:
+                    return False
+                remaining, step_idx = outcome
+                continue
+
             step = remaining[step_idx]
             tool = step.get("tool")
             args = step.get("args", {}) or {}
 
-            ok, result = self._run_step(
+            ok, result, clear = self._run_step(
                 idx=len(steps_done) + 1,
                 total_from_here=len(steps_done) + len(remaining) - step_idx,
                 tool=tool,
@@ -82,9 +149,14 @@ class Executor:
             )
 
             steps_done.append({"tool": tool, "args": args, "ok": ok, "result": result})
-            self.history.append(steps_done[-1])
+            self._remember(steps_done[-1])
 
-            if not ok or not self._is_result_clear(result):
+            if not ok or not clear:
+                # сначала дешёвая локальная починка — без похода в LLM
+                if self._local_repair(tool, result):
+                    self.report(f"🔧 Локальная починка: {tool} — продолжаем")
+                    step_idx += 1
+                    continue
                 # провал или результат "непонятный"
                 if self.replan_mode == "on_error" and self._replans_done < self.max_replans:
                     new_remaining = self._do_replan(
@@ -105,39 +177,173 @@ class Executor:
         self.report("✅ Выполнено")
         return True
 
+    def run_stream(self, goal: str, steps_iter) -> bool:
+        """
+        Исполнение плана, шаги которого приходят из генератора
+        (llm.interpret_stream): первые шаги выполняются, пока LLM ещё
+        дописывает хвост. Параллельных пачек здесь нет — будущие шаги
+        неизвестны до прихода.
+        """
+        self._replans_done = 0
+        self.report(f"🚀 Старт исполнения (стрим): {goal}")
+        self._watchdog = start_watchdog(self._stop, self.report)
+
+        remaining: List[Dict[str, Any]] = []
+        steps_done: List[Dict[str, Any]] = []
+        step_idx = 0
+        exhausted = False
+
+        while True:
+            # дотягиваем следующий шаг из стрима (блокируется на сети, не на COM)
+            while not exhausted and len(remaining) <= step_idx:
+                try:
+                    remaining.append(dict(next(steps_iter)))
+                except StopIteration:
+                    exhausted = True
+            if step_idx >= len(remaining) and exhausted:
+                break
+
+            if self._stop.is_set():
+                self.report("⏹ Остановлено пользователем")
+                return False
+
+            step = remaining[step_idx]
+            tool = step.get("tool")
+            args = step.get("args", {}) or {}
+
+            ok, result, clear = self._run_step(
+                idx=len(steps_done) + 1,
+                total_from_here=len(remaining) - step_idx,
+                tool=tool,
+                args=args,
+            )
+            steps_done.append({"tool": tool, "args": args, "ok": ok, "result": result})
+            self._remember(steps_done[-1])
+
+            if not ok or not clear:
+                if self._local_repair(tool, result):
+                    self.report(f"🔧 Локальная починка: {tool} — продолжаем")
+                    step_idx += 1
+                    continue
+                # для реплана нужен весь хвост — дочитаем стрим
+                if not exhausted:
+                    for s in steps_iter:
+                        remaining.append(dict(s))
+                    exhausted = True
+                if self.replan_mode == "on_error" and self._replans_done < self.max_replans:
+                    new_remaining = self._do_replan(
+                        goal, steps_done, remaining[step_idx + 1:], last_result=result,
+                    )
+                    if new_remaining is not None:
+                        remaining = remaining[: step_idx + 1] + new_remaining
+                        step_idx += 1
+                        continue
+                self.report(f"❌ Шаг провален или непонятен: {tool}")
+                return False
+
+            step_idx += 1
+
+        if not steps_done:
+            # стрим не дал ни одного шага (обрыв сети, парсер не нашёл
+            # объектов) — это провал плана, а не успешное «ничего не делать»
+            self.report("❌ План пуст: стрим не вернул ни одного шага")
+            return False
+        self.report("✅ Выполнено")
+        return True
+
     # ------------------------------
     # Внутренние методы
     # ------------------------------
 
-    def _normalize_args(self, fn, args: Dict[str, Any]) -> Dict[str, Any]:
-        """Отсечь лишние аргументы от LLM (устойчивость к мусору)"""
-        try:
-            sig = inspect.signature(fn)
-            allowed = sig.parameters.keys()
-            return {k: v for k, v in args.items() if k in allowed}
-        except Exception:
-            return args
+    @staticmethod
+    def _summarize_steps(steps: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Схлопнуть список шагов в одну компактную запись-сводку."""
+        count = 0
+        fails = 0
+        tools: Dict[str, int] = {}
+        for s in steps:
+            if "summary" in s:
+                count += int(s.get("count", 0))
+                fails += int(s.get("fails", 0))
+                for t, n in (s.get("tools") or {}).items():
+                    tools[t] = tools.get(t, 0) + n
+                continue
+            count += 1
+            if not s.get("ok"):
+                fails += 1
+            t = s.get("tool") or "?"
+            tools[t] = tools.get(t, 0) + 1
+        text = ", ".join(f"{t}×{n}" for t, n in tools.items())
+        return {
+            "summary": f"выполнено шагов: {count} (провалов: {fails}): {text}",
+            "count": count,
+            "fails": fails,
+            "tools": tools,
+        }
+
+    def _observed(self, key: str, fetch):
+        """Наблюдение с коротким TTL: между кучными репланами модель не меняется."""
+        cached = self._obs_cache.get(key)
+        now = time.monotonic()
+        if cached is not None and cached[1] > now:
+            return cached[0]
+        value = fetch()
+        self._obs_cache[key] = (value, now + _OBS_TTL)
+        return value
+
+    def _remember(self, entry: Dict[str, Any]):
+        """Добавить шаг в историю, при переполнении — сжать хвост в сводку."""
+        # успешная мутация чертежа делает кэш наблюдений неактуальным
+        if entry.get("ok") and str(entry.get("tool") or "").startswith(_MUTATING_PREFIXES):
+            self._obs_cache.clear()
+        self.history.append(entry)
+        if len(self.history) > self.history_cap:
+            old = self.history[: self.history_squash]
+            self.history = [self._summarize_steps(old)] + self.history[self.history_squash:]
 
-    def _is_result_clear(self, result: Dict[str, Any]) -> bool:
+    def _bounded_steps(self, steps: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Версия steps_done для LLM: сводка по старым шагам + последние history_cap."""
+        if len(steps) <= self.history_cap:
+            return steps
+        return [self._summarize_steps(steps[: -self.history_cap])] + steps[-self.history_cap:]
+
+    def _local_repair(self, tool: str, result: Dict[str, Any]) -> bool:
         """
-        Проверка: понятный ли результат.
-        - ok=False → непонятно
-        - есть reason=... → тоже подозрительно, просим LLM уточнить
+        Детерминированная починка типовых сбоев без LLM.
+        True — сбой можно принять и идти дальше.
         """
         if not isinstance(result, dict):
             return False
-        if not result.get("ok", False):
-            return False
-        if "reason" in result and result.get("reason"):
-            return False
-        return True
+        reason = str(result.get("reason") or result.get("error") or "")
+        # пустая модель у контекстных читалок — штатно (план продолжит рисовать с нуля)
+        if tool in _OPTIONAL_CONTEXT_TOOLS and reason in ("no_entities", "empty_model"):
+            return True
+        # «слой уже существует» и подобное — по сути успех
+        if tool in ("acad.ensure_layer", "acad.set_current_layer") and "exist" in reason.lower():
+            return True
+        return False
+
+    def _normalize_args(self, fn, args: Dict[str, Any]) -> Dict[str, Any]:
+        """Отсечь лишние аргументы от LLM (устойчивость к мусору)"""
+        allowed = _SIG_CACHE.get(fn)
+        if allowed is None:
+            try:
+                allowed = frozenset(inspect.signature(fn).parameters)
+            except Exception:
+                return args
+            _SIG_CACHE[fn] = allowed
+        return {k: v for k, v in args.items() if k in allowed}
 
     def _run_step(self, idx: int, total_from_here: int, tool: str, args: Dict[str, Any]):
-        """Выполнить один шаг"""
+        """
+        Выполнить один шаг.
+        Возвращает (ok, result, clear): clear=False — результат «подозрительный»
+        (есть reason=...), просим LLM уточнить.
+        """
         self.report(f" [{idx}/~{idx+total_from_here-1}] {tool} {args}")
         fn = TOOLS.get(tool)
         if not fn:
-            return False, {"error": f"unknown tool {tool}"}
+            return False, {"error": f"unknown tool {tool}"}, False
 
         last_err = None
         for attempt in range(1, STEP_RETRIES + 1):
@@ -147,13 +353,77 @@ class Executor:
                 if not (isinstance(res, dict) and res.get("ok")):
                     raise RuntimeError(f"step returned {res}")
                 self.report(f"  → ok ({attempt})")
-                return True, res
+                reason = res.get("reason")
+                return True, res, (not reason) or (reason not in _BLOCKING_REASONS)
             except Exception as e:
                 last_err = str(e)
                 self.report(f"  ! ошибка попытка {attempt}: {e}")
-                time.sleep(0.4)
+                # wait вместо sleep: стоп-событие прерывает паузу сразу
+                if self._stop.wait(0.4):
+                    break
 
-        return False, {"error": last_err}
+        return False, {"error": last_err}, False
+
+    def _run_parallel_batch(
+        self,
+        goal: str,
+        remaining: List[Dict[str, Any]],
+        start: int,
+        end: int,
+        steps_done: List[Dict[str, Any]],
+    ) -> Optional[tuple]:
+        """
+        Выполнить remaining[start:end] (только читающие инструменты) в пуле потоков.
+        Результаты фиксируются в исходном порядке.
+        Возвращает (remaining, step_idx) для продолжения или None при провале.
+        """
+        batch = remaining[start:end]
+        base_idx = len(steps_done)
+        total = base_idx + len(remaining) - start
+        self.report(f"⚡ Параллельная пачка из {len(batch)} читающих шагов")
+
+        def _one(off_step):
+            off, step = off_step
+            return self._run_step(
+                idx=base_idx + off + 1,
+                total_from_here=total - off,
+                tool=step.get("tool"),
+                args=step.get("args", {}) or {},
+            )
+
+        with ThreadPoolExecutor(max_workers=_MAX_PARALLEL_WORKERS) as pool:
+            results = list(pool.map(_one, enumerate(batch)))
+
+        failed_result = None
+        failed_tool = None
+        for step, (ok, result, clear) in zip(batch, results):
+            steps_done.append({
+                "tool": step.get("tool"),
+                "args": step.get("args", {}) or {},
+                "ok": ok,
+                "result": result,
+            })
+            self._remember(steps_done[-1])
+            if failed_result is None and (not ok or not clear):
+                failed_result = result
+                failed_tool = step.get("tool")
+
+        if failed_result is None:
+            return remaining, end
+
+        if self._local_repair(failed_tool, failed_result):
+            self.report(f"🔧 Локальная починка: {failed_tool} — продолжаем")
+            return remaining, end
+
+        # провал внутри пачки — реплан с хвостом после неё
+        if self.replan_mode == "on_error" and self._replans_done < self.max_replans:
+            new_remaining = self._do_replan(
+                goal, steps_done, remaining[end:], last_result=failed_result
+            )
+            if new_remaining is not None:
+                return remaining[:end] + new_remaining, end
+        self.report(f"❌ Шаг провален или непонятен: {failed_tool}")
+        return None
 
     def _do_replan(
         self,
@@ -164,8 +434,12 @@ class Executor:
     ) -> Optional[List[Dict[str, Any]]]:
         """Выполнить репланирование (с чтением свежего контекста из AutoCAD). Вернуть новый remaining или None."""
         try:
-            doc_info = TOOLS.get("acad.get_current_doc_info", lambda: {"ok": False})()
-            extents = TOOLS.get("acad.get_extents_of_model", lambda: {"ok": False})()
+            doc_info = self._observed(
+                "doc", TOOLS.get("acad.get_current_doc_info", lambda: {"ok": False})
+            )
+            extents = self._observed(
+                "extents", TOOLS.get("acad.get_extents_of_model", lambda: {"ok": False})
+            )
 
             obs = {
                 "last_result": last_result,
@@ -175,7 +449,7 @@ class Executor:
 
             new_remaining = llm.replan(
                 goal=goal,
-                steps_done=steps_done,
+                steps_done=self._bounded_steps(steps_done),
                 remaining_steps=remaining_steps,
                 observation=obs,
             )
@@ -1,15 +1,411 @@
 # -*- coding: utf-8 -*-
 import os
+import re
 import json
-from openai import OpenAI
+import math
+import time
+import random
+import asyncio
+import hashlib
+import inspect
+import functools
+import tempfile
+from pathlib import Path
+from openai import OpenAI, AsyncOpenAI
 from dotenv import load_dotenv
 from .schema import Plan, validate_plan
 
+# orjson парсит в разы быстрее stdlib; без него работаем на json
+try:
+    import orjson
+
+    def _json_loads(s):
+        return orjson.loads(s)
+
+    def _json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+except ImportError:
+    def _json_loads(s):
+        return json.loads(s)
+
+    def _json_dumps(obj) -> str:
+        return json.dumps(obj, ensure_ascii=False)
+
 load_dotenv()
 _client = OpenAI(
     api_key=os.getenv("OPENAI_API_KEY"),
     project=os.getenv("OPENAI_PROJECT_ID"),
 )
+_aclient = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    project=os.getenv("OPENAI_PROJECT_ID"),
+)
+
+# через сколько секунд подключать запасную модель, если основная молчит
+_HEDGE_DELAY = 2.0
+
+# -----------------------
+# РЕТРАИ / ПРЕДОХРАНИТЕЛЬ
+# -----------------------
+# 429 от модели не повод сразу жечь запасную: ждём по Retry-After или
+# экспоненциально с джиттером. 400/401/403 не ретраим — это не временное.
+
+_RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+# предохранитель: после _BREAKER_FAILS подряд провалов модель
+# пропускается на _BREAKER_COOLDOWN секунд
+_BREAKER_FAILS = 3
+_BREAKER_COOLDOWN = 60.0
+_breaker: dict = {}  # model -> {"fails": int, "skip_until": float}
+
+def _breaker_is_open(model: str) -> bool:
+    st = _breaker.get(model)
+    return bool(st and st.get("skip_until", 0.0) > time.monotonic())
+
+def _breaker_record(model: str, ok: bool):
+    st = _breaker.setdefault(model, {"fails": 0, "skip_until": 0.0})
+    if ok:
+        st["fails"] = 0
+        st["skip_until"] = 0.0
+        return
+    st["fails"] += 1
+    if st["fails"] >= _BREAKER_FAILS:
+        st["skip_until"] = time.monotonic() + _BREAKER_COOLDOWN
+        print(f"⛔ Модель {model} отключена на {_BREAKER_COOLDOWN:.0f}с после {st['fails']} провалов")
+
+def _status_code(exc: Exception):
+    return getattr(exc, "status_code", None)
+
+def _retry_after_seconds(exc: Exception):
+    """Достать Retry-After из ответа (есть у openai.RateLimitError и т.п.)."""
+    try:
+        headers = getattr(getattr(exc, "response", None), "headers", None)
+        if headers is not None:
+            ra = headers.get("retry-after")
+            if ra is not None:
+                return float(ra)
+    except Exception:
+        pass
+    return None
+
+def _retry_delay(exc: Exception, attempt: int,
+                 base_delay: float, backoff_factor: float,
+                 max_delay: float, jitter: bool):
+    """
+    Сколько ждать перед следующей попыткой, или None — если ретраить нельзя
+    (неретраибельный статус вроде 400/401/403).
+    """
+    status = _status_code(exc)
+    if status is not None and status not in _RETRYABLE_STATUS:
+        return None
+    wait = _retry_after_seconds(exc)
+    if wait is None:
+        wait = min(base_delay * (backoff_factor ** (attempt - 1)), max_delay)
+        if jitter:
+            wait *= 0.5 + random.random() * 0.5
+    return wait
+
+def with_retry(max_attempts: int = 5, base_delay: float = 1.0,
+               backoff_factor: float = 2.0, max_delay: float = 30.0,
+               jitter: bool = True):
+    """Декоратор: экспоненциальный бэкофф с джиттером и учётом Retry-After."""
+    def deco(fn):
+        def wrapper(*args, **kwargs):
+            for attempt in range(1, max_attempts + 1):
+                try:
+                    return fn(*args, **kwargs)
+                except Exception as e:
+                    wait = _retry_delay(e, attempt, base_delay, backoff_factor, max_delay, jitter)
+                    if wait is None or attempt == max_attempts:
+                        raise
+                    print(f"⏳ Ретрай {attempt}/{max_attempts} через {wait:.1f}с: {e}")
+                    time.sleep(wait)
+        return wrapper
+    return deco
+
+# сервер сам гарантирует валидный JSON — убирает класс сбоев
+# «модель обернула JSON прозой», из-за которых впустую жёгся фолбэк
+_JSON_FORMAT = {"type": "json_object"}
+
+@with_retry()
+def _chat(model: str, messages: list) -> str:
+    resp = _client.chat.completions.create(
+        model=model, messages=messages, response_format=_JSON_FORMAT,
+    )
+    return resp.choices[0].message.content.strip()
+
+async def _achat_raw(model: str, messages: list,
+                     max_attempts: int = 5, base_delay: float = 1.0,
+                     backoff_factor: float = 2.0, max_delay: float = 30.0) -> str:
+    """Асинхронный аналог _chat с той же политикой ретраев."""
+    for attempt in range(1, max_attempts + 1):
+        try:
+            resp = await _aclient.chat.completions.create(
+                model=model, messages=messages, response_format=_JSON_FORMAT,
+            )
+            return resp.choices[0].message.content.strip()
+        except Exception as e:
+            wait = _retry_delay(e, attempt, base_delay, backoff_factor, max_delay, jitter=True)
+            if wait is None or attempt == max_attempts:
+                raise
+            print(f"⏳ Ретрай {attempt}/{max_attempts} через {wait:.1f}с: {e}")
+            await asyncio.sleep(wait)
+
+# -----------------------
+# ДИСКОВЫЙ КЭШ ОТВЕТОВ LLM
+# -----------------------
+# Одинаковый (model, system, user) всегда даёт одинаковый план —
+# держим ответы на диске и не ходим в сеть повторно.
+# Отключение: AGENT_LLM_CACHE=0
+
+_CACHE_DIR = Path(os.getenv("AGENT_LLM_CACHE_DIR", str(Path.home() / ".agent_cache")))
+
+def _cache_enabled() -> bool:
+    return os.getenv("AGENT_LLM_CACHE", "1") != "0"
+
+def _cache_key(model: str, system: str, user: str) -> str:
+    return hashlib.sha256((model + system + user).encode("utf-8")).hexdigest()
+
+def _cache_read(key: str) -> str | None:
+    try:
+        path = _CACHE_DIR / f"{key}.json"
+        if path.is_file():
+            return path.read_text(encoding="utf-8")
+    except Exception:
+        pass
+    return None
+
+def _cache_write(key: str, content: str):
+    """Атомарная запись: tmp-файл + os.replace (чтобы не читать полузаписанное)."""
+    try:
+        _CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=str(_CACHE_DIR), suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp, str(_CACHE_DIR / f"{key}.json"))
+    except Exception:
+        pass  # кэш — только ускорение, не роняем планирование из-за диска
+
+def _cache_delete(key: str):
+    """Выкинуть испорченную запись (невалидный ответ не должен жить вечно)."""
+    try:
+        (_CACHE_DIR / f"{key}.json").unlink(missing_ok=True)
+    except Exception:
+        pass
+
+def _cache_hit(key: str, model: str, parse) -> str | None:
+    """Чтение из кэша с валидацией: непарсящийся ответ удаляется как промах."""
+    hit = _cache_read(key)
+    if hit is None:
+        return None
+    if parse is not None:
+        try:
+            parse(hit)
+        except Exception:
+            _cache_delete(key)
+            return None
+    print(f"💾 Кэш-попадание ({model})")
+    return hit
+
+def _cached_chat(model: str, system: str, user: str, parse=None) -> str:
+    """Чат-запрос с дисковым кэшем по SHA-256(model+system+user).
+
+    parse — валидатор ответа: в кэш попадают только ответы, которые он
+    принял, иначе одна кривая генерация навсегда травила бы этот ключ.
+    """
+    key = _cache_key(model, system, user)
+    if _cache_enabled():
+        hit = _cache_hit(key, model, parse)
+        if hit is not None:
+            return hit
+    if _breaker_is_open(model):
+        raise RuntimeError(f"модель {model} временно отключена предохранителем")
+    try:
+        raw = _chat(model, [
+            {"role": "system", "content": system},
+            {"role": "user", "content": user},
+        ])
+    except Exception:
+        _breaker_record(model, ok=False)
+        raise
+    _breaker_record(model, ok=True)
+    if parse is not None:
+        parse(raw)  # невалидный ответ — исключение наружу, без записи в кэш
+    if _cache_enabled():
+        _cache_write(key, raw)
+    return raw
+
+async def _achat(model: str, system: str, user: str, parse=None) -> str:
+    """Асинхронный вариант _cached_chat (тот же дисковый кэш и валидация)."""
+    key = _cache_key(model, system, user)
+    if _cache_enabled():
+        hit = _cache_hit(key, model, parse)
+        if hit is not None:
+            return hit
+    if _breaker_is_open(model):
+        raise RuntimeError(f"модель {model} временно отключена предохранителем")
+    try:
+        raw = await _achat_raw(model, [
+            {"role": "system", "content": system},
+            {"role": "user", "content": user},
+        ])
+    except Exception:
+        _breaker_record(model, ok=False)
+        raise
+    _breaker_record(model, ok=True)
+    if parse is not None:
+        parse(raw)
+    if _cache_enabled():
+        _cache_write(key, raw)
+    return raw
+
+async def _race_models(models: list, system: str, user: str, parse):
+    """
+    Гонка моделей с хеджем: первая стартует сразу, каждая следующая —
+    через _HEDGE_DELAY. Побеждает первый ответ, прошедший parse();
+    проигравшие задачи отменяются. Так таймаут основной модели не
+    блокирует пользователя — запасная уже в полёте.
+    """
+    async def call(model: str, delay: float):
+        if delay > 0:
+            await asyncio.sleep(delay)
+        raw = await _achat(model, system, user, parse=parse)
+        return model, parse(raw)
+
+    tasks = [asyncio.create_task(call(m, i * _HEDGE_DELAY)) for i, m in enumerate(models)]
+    last_err = None
+    pending = set(tasks)
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for t in done:
+            try:
+                model, parsed = t.result()
+            except Exception as e:
+                last_err = e
+                print(f"⚠️ модель недоступна: {e}")
+                continue
+            for p in pending:
+                p.cancel()
+            return model, parsed
+    raise RuntimeError(f"Нет доступной модели: {last_err}")
+
+# -----------------------
+# СЕМАНТИЧЕСКИЙ КЭШ ПЛАНОВ
+# -----------------------
+# Задачи «квадрат 1000x1000» и «квадрат 1200x1200» дают один и тот же план
+# с другими числами. Храним (эмбеддинг задачи, план) и при косинусной
+# близости выше порога возвращаем план, подставив числа из новой задачи.
+# Вытеснение — LFU с потолком _SEM_CAP записей.
+# Отключение: AGENT_SEM_CACHE=0
+
+_SEM_CACHE_PATH = _CACHE_DIR / "semantic_cache.json"
+_SEM_THRESHOLD = 0.92
+_SEM_CAP = 200
+_EMBED_MODEL = "text-embedding-3-small"
+
+_NUM_RE = re.compile(r"-?\d+(?:\.\d+)?")
+
+def _sem_cache_enabled() -> bool:
+    return os.getenv("AGENT_SEM_CACHE", "1") != "0"
+
+def _embed(text: str) -> list | None:
+    try:
+        resp = _client.embeddings.create(model=_EMBED_MODEL, input=text)
+        return list(resp.data[0].embedding)
+    except Exception as e:
+        print(f"⚠️ эмбеддинг недоступен: {e}")
+        return None
+
+def _cosine(a: list, b: list) -> float:
+    if not a or not b or len(a) != len(b):
+        return -1.0
+    dot = sum(x * y for x, y in zip(a, b))
+    na = math.sqrt(sum(x * x for x in a)) or 1.0
+    nb = math.sqrt(sum(x * x for x in b)) or 1.0
+    return dot / (na * nb)
+
+def _sem_load() -> list:
+    try:
+        if _SEM_CACHE_PATH.is_file():
+            return _json_loads(_SEM_CACHE_PATH.read_text(encoding="utf-8"))
+    except Exception:
+        pass
+    return []
+
+def _sem_save(entries: list):
+    try:
+        _CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=str(_CACHE_DIR), suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(_json_dumps(entries))
+        os.replace(tmp, str(_SEM_CACHE_PATH))
+    except Exception:
+        pass
+
+def _swap_numbers(obj, mapping: dict):
+    """Рекурсивно заменить числовые значения плана по карте {старое: новое}."""
+    if isinstance(obj, dict):
+        return {k: _swap_numbers(v, mapping) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_swap_numbers(v, mapping) for v in obj]
+    if isinstance(obj, (int, float)) and not isinstance(obj, bool):
+        return mapping.get(float(obj), obj)
+    return obj
+
+def _sem_cache_get(task_text: str):
+    """Вернуть Plan из семантического кэша или None."""
+    if not (_cache_enabled() and _sem_cache_enabled()):
+        return None
+    entries = _sem_load()
+    if not entries:
+        return None
+    emb = _embed(task_text)
+    if emb is None:
+        return None
+    best = max(entries, key=lambda en: _cosine(emb, en.get("embedding", [])))
+    score = _cosine(emb, best.get("embedding", []))
+    if score < _SEM_THRESHOLD:
+        return None
+    plan_data = best.get("plan")
+    # подставим числа из новой задачи (позиционно), если их поровну
+    old_nums = _NUM_RE.findall(best.get("task", ""))
+    new_nums = _NUM_RE.findall(task_text)
+    if old_nums and len(old_nums) == len(new_nums) and old_nums != new_nums:
+        mapping: dict = {}
+        for o, n in zip(old_nums, new_nums):
+            o, n = float(o), float(n)
+            if mapping.get(o, n) != n:
+                # «1000x1000» против «1000x2000»: одно и то же старое число
+                # должно стать двумя разными — подмена по значению неоднозначна,
+                # лучше честный поход в LLM, чем валидный, но неверный план
+                return None
+            mapping[o] = n
+        plan_data = _swap_numbers(plan_data, mapping)
+    try:
+        plan = validate_plan(plan_data)
+    except Exception:
+        return None
+    best["freq"] = int(best.get("freq", 0)) + 1
+    _sem_save(entries)
+    print(f"💾 Семантический кэш: сходство {score:.3f}")
+    return plan
+
+def _sem_cache_put(task_text: str, plan: Plan):
+    if not (_cache_enabled() and _sem_cache_enabled()):
+        return
+    emb = _embed(task_text)
+    if emb is None:
+        return
+    entries = _sem_load()
+    while len(entries) >= _SEM_CAP:
+        entries.remove(min(entries, key=lambda en: int(en.get("freq", 0))))
+    entries.append({
+        "task": task_text,
+        "embedding": emb,
+        "plan": plan.model_dump(),
+        "freq": 1,
+    })
+    _sem_save(entries)
 
 # -----------------------
 # SYSTEM PROMPT
@@ -37,17 +433,14 @@ _SYSTEM_PROMPT = """
 - acad.draw_from_model_center(shape:str, size:float, layer?:str)
 - acad.measure_bbox_of_largest_closed(layer?:str)
 - acad.find_closed_polylines(layer?:str, min_vertices?:int, min_area?:float)
-- acad.find_squares(layer?:str, include_lines?:bool, pos_tol?:float, ang_tol_deg?:float, rel_len_tol?:float, min_side?:float, max_count?:int)
 - acad.find_squares(layer?:str, include_lines?:bool, pos_tol?:float, ang_tol_deg?:float, rel_len_tol?:float, min_side?:float, max_count?:int, allow_rectangles?:bool)
 - acad.inscribe_circles_in_squares(layer_name:str, color:int|str, layer_filter?:str, pos_tol?:float, ang_tol_deg?:float, rel_len_tol?:float, min_side?:float, max_count?:int, allow_rectangles?:bool)
 - acad.inscribe_squares_in_circles(layer_name:str, color:int|str, layer_filter?:str, max_count?:int)
 - acad.draw_triangle_roof_over_largest_square(layer_source?:str, layer_result?:str, height_ratio?:float, overhang?:float)
- - acad.draw_triangle_roof_over_largest_square(layer_source?:str, layer_result?:str, height_ratio?:float, overhang?:float)
- - acad.find_circles(layer?:str, min_radius?:float, max_count?:int)
- - acad.pick_largest_circle(layer?:str)
- - acad.make_snowman_from_circle(layer_source?:str, layer_result?:str, color?:int|str, middle_scale?:float, head_scale?:float, gap_ratio?:float, eye_scale?:float)
- - acad.make_snowman_from_circle(layer_source?:str, layer_result?:str, color?:int|str, middle_scale?:float, head_scale?:float, gap_ratio?:float, eye_scale?:float, draw_arms?:bool, draw_legs?:bool, hand_scale?:float, foot_scale?:float)
- - acad.copy_all_on_layer_by_offset(source_layer:str, dx?:float, dy?:float, target_layer?:str, limit?:int)
+- acad.find_circles(layer?:str, min_radius?:float, max_count?:int)
+- acad.pick_largest_circle(layer?:str)
+- acad.make_snowman_from_circle(layer_source?:str, layer_result?:str, color?:int|str, middle_scale?:float, head_scale?:float, gap_ratio?:float, eye_scale?:float, draw_arms?:bool, draw_legs?:bool, hand_scale?:float, foot_scale?:float)
+- acad.copy_all_on_layer_by_offset(source_layer:str, dx?:float, dy?:float, target_layer?:str, limit?:int)
 - acad.get_center_of_model()
 - acad.erase_by_handles(handles:[str])
 - acad.erase_all_on_layer(layer:str)
@@ -72,14 +465,14 @@ _SYSTEM_PROMPT = """
   acad.inscribe_circles_in_squares(layer_name:"<нужный слой>", color:"yellow", layer_filter?: "<если нужно>").
   Не пытайся вручную собирать прямоугольники по линиям — за это отвечает find_squares внутри инструмента.
 - В конце полезно сделать acad.zoom_extents().
- - Перед повторным вписыванием окружностей в тот же слой — очисти дубликаты:
-   добавь шаг acad.erase_by_filter(type_contains:"CIRCLE", layer:"<тот же слой>") до вызова inscribe_circles_in_squares.
- - Если пользователь упоминает прямоугольники, вызывай acad.inscribe_circles_in_squares(..., allow_rectangles:true).
- - Если пользователь просит вписать квадраты в круги, вызывай acad.inscribe_squares_in_circles(...).
- - Если пользователь просит "снеговика" из существующей окружности — используй:
-   acad.make_snowman_from_circle(layer_source?:"<слой с кругами>", layer_result:"SNOWMAN", color:"white").
- - Если попросили «скопировать/сдвинуть» слой со снеговиком — используй
-   acad.copy_all_on_layer_by_offset(source_layer:"SNOWMAN", dx: <смещение>, target_layer?:"SNOWMAN_COPY").
+- Перед повторным вписыванием окружностей в тот же слой — очисти дубликаты:
+  добавь шаг acad.erase_by_filter(type_contains:"CIRCLE", layer:"<тот же слой>") до вызова inscribe_circles_in_squares.
+- Если пользователь упоминает прямоугольники, вызывай acad.inscribe_circles_in_squares(..., allow_rectangles:true).
+- Если пользователь просит вписать квадраты в круги, вызывай acad.inscribe_squares_in_circles(...).
+- Если пользователь просит "снеговика" из существующей окружности — используй:
+  acad.make_snowman_from_circle(layer_source?:"<слой с кругами>", layer_result:"SNOWMAN", color:"white").
+- Если попросили «скопировать/сдвинуть» слой со снеговиком — используй
+  acad.copy_all_on_layer_by_offset(source_layer:"SNOWMAN", dx: <смещение>, target_layer?:"SNOWMAN_COPY").
 """
 
 # -----------------------
@@ -110,26 +503,380 @@ def interpret(task_text: str) -> Plan:
     models = ["gpt-5-mini", "gpt-4o-mini"]
     last_err = None
 
-    for model in models:
+    # точный кэш дешевле семантического (тот ходит в сеть за эмбеддингом)
+    exact_hit = any(
+        _cache_read(_cache_key(m, _SYSTEM_PROMPT, task_text)) is not None
+        for m in models
+    ) if _cache_enabled() else False
+
+    if not exact_hit:
+        plan = _sem_cache_get(task_text)
+        if plan is not None:
+            return plan
+        # структурированный tool-calling — основной путь;
+        # JSON-гонка моделей ниже остаётся фолбэком
         try:
-            resp = _client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": _SYSTEM_PROMPT},
-                    {"role": "user", "content": task_text},
-                ],
-            )
-            raw = resp.choices[0].message.content.strip()
-            data = json.loads(raw)
-            plan = validate_plan(data)
-            print(f"⚡ Использована модель: {model}")
+            plan = interpret_tools(task_text)
+            print("⚡ Использован tool-calling (gpt-5-mini)")
+            _sem_cache_put(task_text, plan)
             return plan
         except Exception as e:
-            last_err = e
-            print(f"⚠️ {model} недоступна: {e}")
-            continue
+            print(f"⚠️ tool-calling не удался, JSON-режим: {e}")
 
-    raise RuntimeError(f"Нет доступной модели: {last_err}")
+    def _parse(raw: str) -> Plan:
+        return validate_plan(_json_loads(raw))
+
+    try:
+        model, plan = asyncio.run(_race_models(models, _SYSTEM_PROMPT, task_text, _parse))
+    except Exception as e:
+        last_err = e
+        raise RuntimeError(f"Нет доступной модели: {last_err}")
+
+    print(f"⚡ Использована модель: {model}")
+    if not exact_hit:
+        _sem_cache_put(task_text, plan)
+    return plan
+
+# -----------------------
+# НАТИВНЫЙ TOOL-CALLING
+# -----------------------
+# Вместо JSON-текста модель возвращает структурированные tool_calls:
+# сервер сам гарантирует валидные имена инструментов и JSON аргументов,
+# «выдуманная» функция становится ошибкой API, а не падением json.loads.
+
+# в именах функций OpenAI точка запрещена — кодируем "acad.x" как "acad__x"
+_TOOL_NAME_SEP = "__"
+
+# _SYSTEM_PROMPT сюда не годится: он требует «строго JSON, никакого текста»,
+# и модель послушно кладёт план в content вместо tool_calls. Здесь список
+# инструментов приходит схемами, промпт задаёт только порядок и доменные
+# правила: все шаги — вызовами инструментов, в одном ответе, по порядку.
+_TOOLS_SYSTEM_PROMPT = """
+Ты инженерный агент-планировщик AutoCAD.
+Преврати запрос пользователя в план: КАЖДЫЙ шаг плана — один вызов
+инструмента (tool call). Выдай ВСЕ шаги сразу, в одном ответе, строго
+в порядке выполнения. Никакого текста в ответе — только вызовы
+инструментов из предоставленного списка.
+
+Перед любыми геометрическими действиями:
+1) ВСЕГДА вызвать acad__get_current_doc_info
+2) Затем acad__get_extents_of_model (если модель пуста — продолжай без него)
+
+ПРАВИЛА:
+- Если цель «вписать окружности в квадраты» — после ensure_layer и
+  set_current_layer сразу вызывай acad__inscribe_circles_in_squares:
+  он сам ищет квадраты (и из полилиний, и из линий), вручную собирать
+  прямоугольники по линиям не нужно.
+- Перед повторным вписыванием окружностей в тот же слой очисти дубликаты:
+  acad__erase_by_filter(type_contains:"CIRCLE", layer:"<тот же слой>").
+- Если пользователь упоминает прямоугольники — allow_rectangles:true.
+- «Вписать квадраты в круги» — acad__inscribe_squares_in_circles.
+- «Снеговик» из существующей окружности — acad__make_snowman_from_circle.
+- «Скопировать/сдвинуть слой» — acad__copy_all_on_layer_by_offset.
+- В конце полезно вызвать acad__zoom_extents.
+"""
+
+def _param_schema(annotation) -> dict:
+    """Очень грубое отображение аннотации параметра в JSON-schema тип."""
+    text = str(annotation).lower()
+    if "bool" in text:
+        return {"type": "boolean"}
+    if "int" in text and "point" not in text:
+        return {"type": "integer"}
+    if "float" in text:
+        return {"type": "number"}
+    if "str" in text:
+        return {"type": "string"}
+    if "list" in text or "tuple" in text:
+        return {"type": "array"}
+    if "dict" in text:
+        return {"type": "object"}
+    return {}
+
+_TOOL_SCHEMAS: list | None = None
+
+def _get_tool_schemas() -> list:
+    """Схемы всех инструментов из реестра TOOLS (строятся один раз)."""
+    global _TOOL_SCHEMAS
+    if _TOOL_SCHEMAS is not None:
+        return _TOOL_SCHEMAS
+    from .tools import TOOLS
+    schemas = []
+    for name, fn in TOOLS.items():
+        props = {}
+        required = []
+        try:
+            sig = inspect.signature(fn)
+        except Exception:
+            sig = None
+        if sig is not None:
+            for pname, p in sig.parameters.items():
+                if p.kind in (inspect.Parameter.VAR_KEYWORD, inspect.Parameter.VAR_POSITIONAL):
+                    continue
+                props[pname] = _param_schema(p.annotation)
+                if p.default is inspect.Parameter.empty:
+                    required.append(pname)
+        # partial-алиасы наследуют докстринг класса functools.partial —
+        # модели нужно описание обёрнутой функции
+        target = fn.func if isinstance(fn, functools.partial) else fn
+        doc = (inspect.getdoc(target) or "").strip().splitlines()
+        schemas.append({
+            "type": "function",
+            "function": {
+                "name": name.replace(".", _TOOL_NAME_SEP),
+                "description": doc[0] if doc else name,
+                "parameters": {
+                    "type": "object",
+                    "properties": props,
+                    "required": required,
+                },
+            },
+        })
+    _TOOL_SCHEMAS = schemas
+    return schemas
+
+@with_retry()
+def _chat_tools(model: str, messages: list, tools: list):
+    return _client.chat.completions.create(
+        model=model, messages=messages, tools=tools, tool_choice="auto",
+    )
+
+def interpret_tools(task_text: str) -> Plan:
+    """
+    Интерпретация задачи через структурированный tool-calling.
+    tool_calls из ответа становятся шагами плана как есть —
+    серверная валидация заменяет pydantic-разбор сырого JSON.
+    Та же обвязка, что у JSON-пути: ретраи с бэкоффом, предохранитель
+    и дисковый кэш (ответ — не сырой текст, поэтому кэшируем готовый
+    план под отдельным ключом).
+    """
+    model = "gpt-5-mini"
+    key = _cache_key(model + "#tools", _TOOLS_SYSTEM_PROMPT, task_text)
+    if _cache_enabled():
+        hit = _cache_read(key)
+        if hit is not None:
+            try:
+                plan = validate_plan(_json_loads(hit))
+            except Exception:
+                _cache_delete(key)
+            else:
+                print(f"💾 Кэш-попадание ({model}, tools)")
+                return plan
+    if _breaker_is_open(model):
+        raise RuntimeError(f"модель {model} временно отключена предохранителем")
+    try:
+        resp = _chat_tools(model, [
+            {"role": "system", "content": _TOOLS_SYSTEM_PROMPT},
+            {"role": "user", "content": task_text},
+        ], _get_tool_schemas())
+    except Exception:
+        _breaker_record(model, ok=False)
+        raise
+    _breaker_record(model, ok=True)
+    calls = resp.choices[0].message.tool_calls or []
+    if not calls:
+        raise RuntimeError("модель не вернула tool_calls")
+    steps = [
+        {
+            "tool": c.function.name.replace(_TOOL_NAME_SEP, "."),
+            "args": _json_loads(c.function.arguments or "{}"),
+        }
+        for c in calls
+    ]
+    plan = Plan(goal=task_text, steps=steps)
+    if _cache_enabled():
+        _cache_write(key, _json_dumps(plan.model_dump()))
+    return plan
+
+class _StepStreamParser:
+    """
+    Инкрементальный разбор {"goal": ..., "steps": [{...}, ...]} по мере
+    прихода чанков стрима: скобочный счётчик с учётом строк/экранирования.
+    Каждый полностью пришедший объект-шаг отдаётся сразу.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.obj_start = None
+
+    def feed(self, chunk: str) -> list:
+        done_steps = []
+        for ch in chunk:
+            self.text += ch
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                continue
+            if ch == '"':
+                self.in_string = True
+            elif ch in "{[":
+                self.depth += 1
+                # глубина 3 = объект-шаг внутри steps внутри корневого объекта
+                if ch == "{" and self.depth == 3 and self.obj_start is None:
+                    self.obj_start = len(self.text) - 1
+            elif ch in "}]":
+                self.depth -= 1
+                if self.depth == 2 and self.obj_start is not None:
+                    frag = self.text[self.obj_start:]
+                    self.obj_start = None
+                    try:
+                        done_steps.append(_json_loads(frag))
+                    except Exception:
+                        pass
+        return done_steps
+
+def interpret_stream(task_text: str):
+    """
+    Потоковая интерпретация: шаги плана отдаются по мере генерации моделью,
+    так что первые COM-вызовы идут параллельно с дописыванием хвоста плана.
+    Генератор словарей-шагов; при недоступности стрима — фолбэк на interpret().
+    """
+    model = "gpt-5-mini"
+    # CLI ходит только через стрим, поэтому кэши читаем и здесь — иначе
+    # повторная идентичная задача шла бы в сеть, а кэши были бы write-only
+    if _cache_enabled():
+        key = _cache_key(model, _SYSTEM_PROMPT, task_text)
+        hit = _cache_read(key)
+        if hit is not None:
+            try:
+                plan = validate_plan(_json_loads(hit))
+            except Exception:
+                _cache_delete(key)
+            else:
+                print(f"💾 Кэш-попадание ({model})")
+                for s in plan.steps:
+                    yield s.model_dump()
+                return
+        plan = _sem_cache_get(task_text)
+        if plan is not None:
+            for s in plan.steps:
+                yield s.model_dump()
+            return
+    yielded = 0
+    try:
+        stream = _client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": _SYSTEM_PROMPT},
+                {"role": "user", "content": task_text},
+            ],
+            response_format=_JSON_FORMAT,
+            stream=True,
+        )
+        parser = _StepStreamParser()
+        for event in stream:
+            delta = event.choices[0].delta.content if event.choices else None
+            if not delta:
+                continue
+            for step in parser.feed(delta):
+                yielded += 1
+                yield step
+        # полный ответ — в обычный дисковый кэш (interpret() его переиспользует),
+        # но только если он собирается в валидный план
+        raw = parser.text.strip()
+        if raw and _cache_enabled():
+            try:
+                plan = validate_plan(_json_loads(raw))
+            except Exception:
+                pass
+            else:
+                _cache_write(_cache_key(model, _SYSTEM_PROMPT, task_text), raw)
+                _sem_cache_put(task_text, plan)
+        return
+    except Exception as e:
+        if yielded:
+            # часть шагов уже ушла исполнителю — дублировать их нельзя
+            raise
+        print(f"⚠️ Стрим не удался, обычный режим: {e}")
+    plan = interpret(task_text)
+    for s in plan.steps:
+        yield s.model_dump()
+
+_BATCH_MIN = 4           # меньше — дешевле прогнать по одному
+_BATCH_POLL_SEC = 5.0    # период опроса статуса батча
+_BATCH_TIMEOUT = 900.0   # дольше ждать батч нет смысла — поштучно быстрее
+
+def interpret_many(tasks: list, timeout_sec: float = _BATCH_TIMEOUT) -> list:
+    """
+    Пакетная интерпретация списка задач через OpenAI Batch API.
+    Одна загрузка JSONL вместо N HTTP-запросов: амортизирует сетевые
+    накладные расходы и даёт батч-тариф. Для < _BATCH_MIN задач (или при
+    сбое/таймауте батча) — обычный последовательный interpret().
+    """
+    if len(tasks) < _BATCH_MIN:
+        return [interpret(t) for t in tasks]
+
+    model = "gpt-5-mini"
+    try:
+        lines = []
+        for i, task in enumerate(tasks):
+            lines.append(json.dumps({
+                "custom_id": str(i),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": model,
+                    "messages": [
+                        {"role": "system", "content": _SYSTEM_PROMPT},
+                        {"role": "user", "content": task},
+                    ],
+                    "response_format": {"type": "json_object"},
+                },
+            }, ensure_ascii=False))
+
+        fd, tmp = tempfile.mkstemp(suffix=".jsonl")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write("\n".join(lines))
+            with open(tmp, "rb") as f:
+                batch_file = _client.files.create(file=f, purpose="batch")
+        finally:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+        batch = _client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        print(f"📦 Батч {batch.id}: {len(tasks)} задач")
+        # окно батча — 24 часа; столько ждать интерактивный агент не может,
+        # поэтому опрос ограничен дедлайном, после — поштучный режим
+        deadline = time.monotonic() + timeout_sec
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            if time.monotonic() >= deadline:
+                try:
+                    _client.batches.cancel(batch.id)
+                except Exception:
+                    pass
+                raise RuntimeError(f"batch timeout after {timeout_sec:.0f}s")
+            time.sleep(_BATCH_POLL_SEC)
+            batch = _client.batches.retrieve(batch.id)
+        if batch.status != "completed":
+            raise RuntimeError(f"batch status: {batch.status}")
+
+        content = _client.files.content(batch.output_file_id).text
+        # ответы приходят в произвольном порядке — восстановим по custom_id
+        by_id = {}
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            obj = _json_loads(line)
+            raw = obj["response"]["body"]["choices"][0]["message"]["content"].strip()
+            by_id[obj["custom_id"]] = validate_plan(_json_loads(raw))
+        return [by_id[str(i)] for i in range(len(tasks))]
+    except Exception as e:
+        print(f"⚠️ Батч не удался, переходим на поштучный режим: {e}")
+        return [interpret(t) for t in tasks]
 
 def replan(goal: str, steps_done: list, remaining_steps: list, observation: dict) -> list:
     """Запрос к LLM на корректировку оставшихся шагов."""
@@ -143,15 +890,9 @@ def replan(goal: str, steps_done: list, remaining_steps: list, observation: dict
 
     for model in models:
         try:
-            resp = _client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": _REPLANNER_PROMPT},
-                    {"role": "user", "content": json.dumps(payload, ensure_ascii=False)},
-                ],
-            )
-            raw = resp.choices[0].message.content.strip()
-            data = json.loads(raw)
+            raw = _cached_chat(model, _REPLANNER_PROMPT, _json_dumps(payload),
+                               parse=_json_loads)
+            data = _json_loads(raw)
             steps = data.get("steps", [])
             print(f"🔁 Реплан с моделью: {model}, осталось шагов: {len(steps)}")
             return steps
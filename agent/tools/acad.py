@@ -1,10 +1,36 @@
 from __future__ import annotations
 from typing import List, Tuple, Dict, Any, Optional, Iterable, Set
+import array
+import contextlib
 import math
+import os
 import time
+import weakref
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 from pyautocad import Autocad, APoint, aDouble
 
+# numba опционален: с ним скалярные геометрические хелперы компилируются
+# в нативный код (cache=True переживает перезапуски), без него — чистый Python
+try:
+    from numba import njit as _njit
+except ImportError:
+    def _njit(*dargs, **dkwargs):
+        if dargs and callable(dargs[0]):
+            return dargs[0]
+        def deco(fn):
+            return fn
+        return deco
+
+# ezdxf опционален: AGENT_CAD_BACKEND=ezdxf переводит рисовалки на офлайн
+# DXF-документ (чистый Python, без COM) — для генерации без живого AutoCAD
+try:
+    import ezdxf as _ezdxf
+except ImportError:
+    _ezdxf = None
+
 # =====================================================
 # НАСТРОЙКИ / ТОЧНОСТИ
 # =====================================================
@@ -15,45 +41,194 @@ _ANG_TOL_DEG = 1.0         # допуск на прямой угол (в гра
 _REL_LEN_TOL = 0.02        # относительный допуск равенства сторон (2%)
 _MIN_SIDE = 1e-6           # минимальная сторона квадрата (чтобы отсеять мусор)
 
+# от этого размера батч-проверку кандидатов режем на куски по потокам
+_PAR_CHUNK = 2048
+
 # =====================================================
 # ВНУТРЕННИЕ ХЕЛПЕРЫ: COM/AutoCAD
 # =====================================================
 
+# Подключение к AutoCAD кэшируется на уровне модуля: COM-запрос на каждый
+# вызов инструмента — это сотни миллисекунд на длинном плане.
+_ACAD: Optional[Autocad] = None
+_ACAD_LOCK = threading.Lock()
+
+def _acad_alive(acad: Autocad) -> bool:
+    """Жив ли COM-объект (AutoCAD могли закрыть между шагами)."""
+    try:
+        _ = acad.doc
+        return True
+    except Exception:
+        return False
+
 def _get_acad(retries: int = 5, sleep_sec: float = 0.2) -> Autocad:
-    """Создает/возвращает подключение к AutoCAD через COM (с ретраями)."""
-    last_err = None
-    for _ in range(retries):
-        try:
-            return Autocad(create_if_not_exists=True)
-        except Exception as e:
-            last_err = e
-            time.sleep(sleep_sec)
-    # если упорно не удаётся — пробросим исключение
-    raise RuntimeError(f"AutoCAD COM init failed: {last_err}")
+    """Возвращает кэшированное подключение к AutoCAD через COM (с ретраями)."""
+    global _ACAD
+    acad = _ACAD
+    if acad is not None and _acad_alive(acad):
+        return acad
+    with _ACAD_LOCK:
+        # double-checked: пока ждали лок, другой поток мог переподключиться
+        if _ACAD is not None and _acad_alive(_ACAD):
+            return _ACAD
+        last_err = None
+        for _ in range(retries):
+            try:
+                _ACAD = Autocad(create_if_not_exists=True)
+                # старый ModelSpace-диспетч и снимок держат мёртвые COM-указатели
+                _invalidate_doc_cache()
+                _invalidate_ms_cache()
+                return _ACAD
+            except Exception as e:
+                last_err = e
+                time.sleep(sleep_sec)
+        # если упорно не удаётся — пробросим исключение
+        raise RuntimeError(f"AutoCAD COM init failed: {last_err}")
+
+# --- офлайн-бэкенд (ezdxf) ---------------------------------------
+# Рисуем в DXF-документ в памяти; save_as пишет файл. Инструменты чтения
+# (find_*, list_*) по-прежнему требуют живой AutoCAD.
+
+_EZDXF_DOC = None
+_EZDXF_LOCK = threading.Lock()
+
+def _use_ezdxf() -> bool:
+    return _ezdxf is not None and os.getenv("AGENT_CAD_BACKEND", "").lower() == "ezdxf"
+
+def _ezdxf_msp():
+    global _EZDXF_DOC
+    if _EZDXF_DOC is None:
+        with _EZDXF_LOCK:
+            if _EZDXF_DOC is None:
+                _EZDXF_DOC = _ezdxf.new(setup=True)
+    return _EZDXF_DOC.modelspace()
 
 def _doc():
     return _get_acad().doc
 
+# ModelSpace-диспетч кэшируем по имени активного документа: каждый draw_*
+# иначе делает два COM-чтения (doc + ModelSpace) только ради «адреса» модели.
+# Имя документа — одно дешёвое чтение и одновременно признак смены DWG.
+_MS_CACHE: Dict[str, Any] = {"name": None, "ms": None}
+
 def _ms():
-    return _doc().ModelSpace
+    doc = _doc()
+    try:
+        name = doc.Name
+    except Exception:
+        name = None
+    if name is not None and name == _MS_CACHE["name"] and _MS_CACHE["ms"] is not None:
+        return _MS_CACHE["ms"]
+    ms = doc.ModelSpace
+    _MS_CACHE["name"] = name
+    _MS_CACHE["ms"] = ms
+    return ms
+
+def _invalidate_doc_cache():
+    """Сбросить кэш ModelSpace (после SaveAs/смены документа)."""
+    _MS_CACHE["name"] = None
+    _MS_CACHE["ms"] = None
+
+# -----------------------------------------------------
+# Снимок ModelSpace: каждый `for e in ms` — это N COM-переходов, а
+# многопроходные инструменты (inscribe_circles_in_squares и т.п.) обходят
+# модель по несколько раз. Держим один снимок
+# [(entity, name_lower, layer, handle)] и сбрасываем его при мутациях.
+# -----------------------------------------------------
+
+_ms_snapshot: Optional[List[tuple]] = None
+_ms_snapshot_doc: Optional[str] = None  # имя DWG, для которого снят снимок
+_ms_snapshot_lock = threading.Lock()
+
+def _invalidate_ms_cache():
+    """Сбросить снимок (вызывается после draw_*/erase_*/copy_*/save_as)."""
+    global _ms_snapshot, _ms_snapshot_doc
+    _ms_snapshot = None
+    _ms_snapshot_doc = None
+
+def _ms_cached() -> List[tuple]:
+    """Снимок ModelSpace: (entity, name_lower, layer, handle, geo) за один обход.
+
+    geo — геометрия, выбранная сразу при построении снимка, чтобы горячие
+    сканы не ходили в COM по одному свойству на каждую итерацию:
+    для LINE это ((x1,y1),(x2,y2)), для CIRCLE — ((cx,cy), r), иначе None.
+    Снимок привязан к имени документа: смена DWG строит его заново.
+    """
+    global _ms_snapshot, _ms_snapshot_doc
+    ms = _ms()  # заодно освежает _MS_CACHE["name"] одним дешёвым чтением
+    name = _MS_CACHE["name"]
+    snap = _ms_snapshot
+    if snap is not None and name is not None and name == _ms_snapshot_doc:
+        return snap
+    with _ms_snapshot_lock:
+        if (_ms_snapshot is not None and name is not None
+                and name == _ms_snapshot_doc):
+            return _ms_snapshot
+        snap = []
+        for e in ms:
+            nm = _name_lower(_object_name(e))
+            geo = None
+            try:
+                if "circle" in nm:
+                    c = e.Center
+                    geo = ((float(c[0]), float(c[1])), float(e.Radius))
+                elif "line" in nm and "polyline" not in nm:
+                    sp = e.StartPoint; ep = e.EndPoint
+                    geo = ((float(sp[0]), float(sp[1])),
+                           (float(ep[0]), float(ep[1])))
+            except Exception:
+                geo = None
+            snap.append((e, nm, getattr(e, "Layer", None), getattr(e, "Handle", None), geo))
+        _ms_snapshot = snap
+        _ms_snapshot_doc = name
+        return snap
+
+# ObjectName — это IPC-запрос к AutoCAD; один и тот же объект пробегает через
+# несколько фильтров за вызов, поэтому имя кэшируем по самой сущности
+_entity_name_cache: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+# Разных ObjectName в чертеже единицы («AcDbLine», «AcDbCircle», ...),
+# поэтому .lower() считаем один раз на имя, а не на сущность
+_name_lower_cache: Dict[str, str] = {}
+
+def _name_lower(name: str) -> str:
+    lo = _name_lower_cache.get(name)
+    if lo is None:
+        lo = name.lower()
+        _name_lower_cache[name] = lo
+    return lo
 
 def _object_name(e) -> str:
     try:
-        name = getattr(e, "ObjectName", "") or ""
-        return str(name)
+        cached = _entity_name_cache.get(e)
+        if cached is not None:
+            return cached
+    except Exception:
+        pass  # COM-прокси может не поддерживать weakref/хэш
+    try:
+        name = str(getattr(e, "ObjectName", "") or "")
     except Exception:
         return ""
+    try:
+        _entity_name_cache[e] = name
+    except Exception:
+        pass
+    return name
 
-def _is_type(e, contains: str) -> bool:
-    return contains.lower() in _object_name(e).lower()
+def _is_type(e, contains: str, name_lower: str | None = None) -> bool:
+    if name_lower is None:
+        name_lower = _name_lower(_object_name(e))
+    return contains.lower() in name_lower
 
 # =====================================================
 # ВНУТРЕННИЕ ХЕЛПЕРЫ: ГЕОМЕТРИЯ
 # =====================================================
 
+@_njit(cache=True)
 def _dist(p: Tuple[float, float], q: Tuple[float, float]) -> float:
     return math.hypot(p[0] - q[0], p[1] - q[1])
 
+@_njit(cache=True)
 def _near(a: float, b: float, rel_tol: float = _REL_LEN_TOL, abs_tol: float = _POS_TOL) -> bool:
     if abs(a - b) <= abs_tol:
         return True
@@ -61,65 +236,123 @@ def _near(a: float, b: float, rel_tol: float = _REL_LEN_TOL, abs_tol: float = _P
     m = max(abs(a), abs(b), abs_tol)
     return abs(a - b) / m <= rel_tol
 
+@_njit(cache=True)
 def _angle_deg(a: Tuple[float, float], b: Tuple[float, float], c: Tuple[float, float]) -> float:
     """Угол ABC в градусах."""
-    v1 = (a[0]-b[0], a[1]-b[1])
-    v2 = (c[0]-b[0], c[1]-b[1])
-    n1 = math.hypot(*v1) or 1.0
-    n2 = math.hypot(*v2) or 1.0
-    v1 = (v1[0]/n1, v1[1]/n1)
-    v2 = (v2[0]/n2, v2[1]/n2)
-    dot = max(-1.0, min(1.0, v1[0]*v2[0] + v1[1]*v2[1]))
+    v1x = a[0] - b[0]; v1y = a[1] - b[1]
+    v2x = c[0] - b[0]; v2y = c[1] - b[1]
+    n1 = math.hypot(v1x, v1y)
+    if n1 == 0.0:
+        n1 = 1.0
+    n2 = math.hypot(v2x, v2y)
+    if n2 == 0.0:
+        n2 = 1.0
+    dot = (v1x * v2x + v1y * v2y) / (n1 * n2)
+    dot = max(-1.0, min(1.0, dot))
     return math.degrees(math.acos(dot))
 
 def _bbox_from_points_3d(pts3: List[Tuple[float, float, float]]):
     if not pts3:
         return None
-    xs = [p[0] for p in pts3]; ys = [p[1] for p in pts3]; zs = [p[2] for p in pts3]
-    return ( (min(xs), min(ys), min(zs)), (max(xs), max(ys), max(zs)) )
+    pts = np.asarray(pts3, dtype=np.float64)
+    mn = pts.min(axis=0); mx = pts.max(axis=0)
+    return ( (float(mn[0]), float(mn[1]), float(mn[2])),
+             (float(mx[0]), float(mx[1]), float(mx[2])) )
 
 def _bbox_from_points_2d(pts2: List[Tuple[float, float]]):
     if not pts2:
         return None
-    xs = [p[0] for p in pts2]; ys = [p[1] for p in pts2]
-    return ( (min(xs), min(ys)), (max(xs), max(ys)) )
+    pts = np.asarray(pts2, dtype=np.float64)
+    mn = pts.min(axis=0); mx = pts.max(axis=0)
+    return ( (float(mn[0]), float(mn[1])), (float(mx[0]), float(mx[1])) )
 
 def _poly_area_xy(pts2: List[Tuple[float, float]]) -> float:
+    """Площадь по формуле шнурков (векторизовано)."""
     if len(pts2) < 3:
         return 0.0
-    s = 0.0
-    n = len(pts2)
-    for i in range(n):
-        x1, y1 = pts2[i]
-        x2, y2 = pts2[(i + 1) % n]
-        s += x1 * y2 - x2 * y1
-    return abs(s) * 0.5
+    pts = np.asarray(pts2, dtype=np.float64)
+    x = pts[:, 0]; y = pts[:, 1]
+    return float(abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))) * 0.5)
 
 def _centroid(pts2: List[Tuple[float, float]]):
     """Центроид многоугольника. Использует подписанную площадь (устойчив к CW/CCW)."""
+    pts = np.asarray(pts2, dtype=np.float64)
     if len(pts2) < 3:
-        x = sum(p[0] for p in pts2) / max(1, len(pts2))
-        y = sum(p[1] for p in pts2) / max(1, len(pts2))
-        return (x, y)
-    signed_sum = 0.0
-    cx_num = 0.0
-    cy_num = 0.0
-    n = len(pts2)
-    for i in range(n):
-        x1, y1 = pts2[i]
-        x2, y2 = pts2[(i + 1) % n]
-        cross = x1 * y2 - x2 * y1
-        signed_sum += cross
-        cx_num += (x1 + x2) * cross
-        cy_num += (y1 + y2) * cross
-    A = signed_sum / 2.0
+        if not pts2:
+            return (0.0, 0.0)
+        m = pts.mean(axis=0)
+        return (float(m[0]), float(m[1]))
+    x1 = pts[:, 0]; y1 = pts[:, 1]
+    x2 = np.roll(x1, -1); y2 = np.roll(y1, -1)
+    cross = x1 * y2 - x2 * y1
+    A = cross.sum() / 2.0
     if abs(A) <= _POS_TOL:
-        x = sum(p[0] for p in pts2) / n
-        y = sum(p[1] for p in pts2) / n
-        return (x, y)
-    cx = cx_num / (6.0 * A)
-    cy = cy_num / (6.0 * A)
-    return (cx, cy)
+        m = pts.mean(axis=0)
+        return (float(m[0]), float(m[1]))
+    cx = ((x1 + x2) * cross).sum() / (6.0 * A)
+    cy = ((y1 + y2) * cross).sum() / (6.0 * A)
+    return (float(cx), float(cy))
+
+def _near_arr(a: np.ndarray, b: np.ndarray,
+              rel_tol: float = _REL_LEN_TOL, abs_tol: float = _POS_TOL) -> np.ndarray:
+    """Векторный аналог _near: поэлементное «почти равно»."""
+    dev = np.abs(a - b)
+    scale = np.maximum(np.maximum(np.abs(a), np.abs(b)), abs_tol)
+    return (dev <= abs_tol) | (dev / scale <= rel_tol)
+
+def _batch_quad_mask(verts: np.ndarray,
+                     ang_tol_deg: float = _ANG_TOL_DEG,
+                     rel_len_tol: float = _REL_LEN_TOL,
+                     min_side: float = _MIN_SIDE,
+                     allow_rectangles: bool = False) -> np.ndarray:
+    """
+    Батч-проверка кандидатов (N,4,2): какие четырёхугольники — квадраты
+    (или прямоугольники, если allow_rectangles). Один вызов NumPy вместо
+    цикла по кандидатам с math.acos на каждый угол.
+    """
+    if verts.size == 0:
+        return np.zeros(0, dtype=bool)
+    verts = np.asarray(verts, dtype=np.float64)
+
+    # стороны: i → i+1 по контуру
+    sides = np.linalg.norm(np.roll(verts, -1, axis=1) - verts, axis=2)  # (N,4)
+    ok = np.all(sides >= min_side, axis=1)
+
+    # углы при вершинах ≈ 90°
+    v_prev = np.roll(verts, 1, axis=1) - verts
+    v_next = np.roll(verts, -1, axis=1) - verts
+    n_prev = np.linalg.norm(v_prev, axis=2)
+    n_next = np.linalg.norm(v_next, axis=2)
+    denom = np.maximum(n_prev * n_next, _POS_TOL)
+    cos = np.clip(np.einsum("ijk,ijk->ij", v_prev, v_next) / denom, -1.0, 1.0)
+    angs = np.degrees(np.arccos(cos))                                   # (N,4)
+    ok &= np.all(np.abs(angs - 90.0) <= ang_tol_deg, axis=1)
+
+    # квадрат: все стороны ≈ средней
+    s_mean = sides.mean(axis=1, keepdims=True)
+    is_square = np.all(_near_arr(sides, s_mean, rel_tol=rel_len_tol), axis=1)
+    if allow_rectangles:
+        # прямоугольник: противоположные стороны ≈ равны
+        is_rect = (_near_arr(sides[:, 0], sides[:, 2], rel_tol=rel_len_tol) &
+                   _near_arr(sides[:, 1], sides[:, 3], rel_tol=rel_len_tol))
+        return ok & (is_square | is_rect)
+    return ok & is_square
+
+def _batch_centroids(verts: np.ndarray) -> np.ndarray:
+    """Центроиды пачки многоугольников (N,M,2) — батч-версия _centroid."""
+    x1 = verts[:, :, 0]; y1 = verts[:, :, 1]
+    x2 = np.roll(x1, -1, axis=1); y2 = np.roll(y1, -1, axis=1)
+    cross = x1 * y2 - x2 * y1
+    A = cross.sum(axis=1) / 2.0
+    means = verts.mean(axis=1)
+    safe_A = np.where(np.abs(A) <= _POS_TOL, 1.0, A)
+    cx = ((x1 + x2) * cross).sum(axis=1) / (6.0 * safe_A)
+    cy = ((y1 + y2) * cross).sum(axis=1) / (6.0 * safe_A)
+    centers = np.stack([cx, cy], axis=1)
+    # вырожденные контуры (нулевая площадь) — обычное среднее вершин
+    degenerate = np.abs(A) <= _POS_TOL
+    centers[degenerate] = means[degenerate]
+    return centers
 
 def _is_square_vertices(verts: List[Tuple[float, float]],
                         ang_tol_deg: float = _ANG_TOL_DEG,
@@ -128,29 +361,10 @@ def _is_square_vertices(verts: List[Tuple[float, float]],
     """Проверяет, что 4 вершины образуют квадрат (порядок по контуру!)."""
     if len(verts) != 4:
         return False
-    # стороны
-    sides = [
-        _dist(verts[0], verts[1]),
-        _dist(verts[1], verts[2]),
-        _dist(verts[2], verts[3]),
-        _dist(verts[3], verts[0]),
-    ]
-    if any(s < min_side for s in sides):
-        return False
-    # равенство сторон
-    s_mean = sum(sides) / 4.0
-    if any(not _near(s, s_mean, rel_tol=rel_len_tol) for s in sides):
-        return False
-    # углы ≈ 90°
-    angs = [
-        _angle_deg(verts[3], verts[0], verts[1]),
-        _angle_deg(verts[0], verts[1], verts[2]),
-        _angle_deg(verts[1], verts[2], verts[3]),
-        _angle_deg(verts[2], verts[3], verts[0]),
-    ]
-    if any(abs(a - 90.0) > ang_tol_deg for a in angs):
-        return False
-    return True
+    mask = _batch_quad_mask(np.asarray([verts], dtype=np.float64),
+                            ang_tol_deg=ang_tol_deg, rel_len_tol=rel_len_tol,
+                            min_side=min_side, allow_rectangles=False)
+    return bool(mask[0])
 
 def _is_rectangle_vertices(verts,
                            ang_tol_deg: float = _ANG_TOL_DEG,
@@ -158,25 +372,10 @@ def _is_rectangle_vertices(verts,
                            min_side: float = _MIN_SIDE):
     if len(verts) != 4:
         return False
-    sides = [
-        _dist(verts[0], verts[1]),
-        _dist(verts[1], verts[2]),
-        _dist(verts[2], verts[3]),
-        _dist(verts[3], verts[0]),
-    ]
-    if any(s < min_side for s in sides):
-        return False
-    # прямые углы
-    angs = [
-        _angle_deg(verts[3], verts[0], verts[1]),
-        _angle_deg(verts[0], verts[1], verts[2]),
-        _angle_deg(verts[1], verts[2], verts[3]),
-        _angle_deg(verts[2], verts[3], verts[0]),
-    ]
-    if any(abs(a - 90.0) > ang_tol_deg for a in angs):
-        return False
-    # противоположные стороны ≈ равны
-    return _near(sides[0], sides[2], rel_tol=rel_len_tol) and _near(sides[1], sides[3], rel_tol=rel_len_tol)
+    mask = _batch_quad_mask(np.asarray([verts], dtype=np.float64),
+                            ang_tol_deg=ang_tol_deg, rel_len_tol=rel_len_tol,
+                            min_side=min_side, allow_rectangles=True)
+    return bool(mask[0])
 
 def _order_loop(points: List[Tuple[float, float]]) -> List[Tuple[float, float]]:
     """Упорядочить 4 точки по контуру (для наборов из линий). Простой способ: начать с левой-нижней и идти по ближнему."""
@@ -241,13 +440,13 @@ def _polyline_vertices_2d_ordered(e) -> List[Tuple[float, float]]:
 
 def _get_bbox_entity(e):
     """Попытаться получить bbox для объекта e."""
-    name = _object_name(e)
+    name = _name_lower(_object_name(e))
     # Polyline
-    if "polyline" in name.lower():
+    if "polyline" in name:
         pts3 = _coords_from_polyline(e)
         return _bbox_from_points_3d(pts3)
     # Line
-    if "line" in name.lower() and "polyline" not in name.lower():
+    if "line" in name:
         try:
             sp = e.StartPoint; ep = e.EndPoint
             return _bbox_from_points_3d([(float(sp[0]), float(sp[1]), float(sp[2])),
@@ -255,7 +454,7 @@ def _get_bbox_entity(e):
         except Exception:
             return None
     # Circle
-    if "circle" in name.lower():
+    if "circle" in name:
         try:
             c = e.Center; r = float(e.Radius)
             return ((c[0]-r, c[1]-r, 0.0), (c[0]+r, c[1]+r, 0.0))
@@ -279,20 +478,29 @@ def _get_bbox_entity(e):
 # БАЗОВЫЕ РИСОВАЛКИ
 # =====================================================
 
+# Таблица имя→ACI строится один раз: ensure_layer дёргается из каждой
+# высокоуровневой операции, пересоздавать dict на каждый вызов незачем
+_ACI_TABLE = {
+    "red": 1, "желтый": 2, "yellow": 2, "green": 3, "cyan": 4,
+    "blue": 5, "magenta": 6, "white": 7, "black": 7,
+}
+
 def _color_to_aci(color: Any) -> int:
     """Преобразовать строковый цвет в ACI или пропустить int."""
     if isinstance(color, int):
         return color
     if isinstance(color, str):
-        c = color.strip().lower()
-        table = {
-            "red": 1, "желтый": 2, "yellow": 2, "green": 3, "cyan": 4,
-            "blue": 5, "magenta": 6, "white": 7, "black": 7,
-        }
-        return table.get(c, 7)
+        return _ACI_TABLE.get(color.strip().lower(), 7)
     return 7
 
 def ensure_layer(name: str, color: Any = 3, **kwargs):
+    if _use_ezdxf():
+        _ezdxf_msp()  # инициализация документа
+        try:
+            _EZDXF_DOC.layers.add(name, color=_color_to_aci(color))
+        except Exception:
+            pass  # слой уже есть
+        return {"ok": True, "layer": name}
     acad = _get_acad()
     layers = acad.doc.Layers
     try:
@@ -307,23 +515,157 @@ def ensure_layer(name: str, color: Any = 3, **kwargs):
     return {"ok": True, "layer": name}
 
 def set_current_layer(name: str, **kwargs):
+    if _use_ezdxf():
+        _ezdxf_msp()
+        _EZDXF_DOC.header["$CLAYER"] = name
+        return {"ok": True, "layer": name}
     acad = _get_acad()
     acad.doc.ActiveLayer = acad.doc.Layers.Item(name)
     return {"ok": True, "layer": name}
 
-def _to_3d_flat(points_2d: List[Tuple[float, float]]) -> List[float]:
-    flat: List[float] = []
+def _to_3d_flat(points_2d: List[Tuple[float, float]]) -> array.array:
+    """Плоский буфер (x, y, 0)*N как array('d'): без 3N временных float-объектов.
+    aDouble принимает такой буфер целиком — распаковка через * не нужна."""
+    buf = array.array("d", bytes(24 * len(points_2d)))  # нули
+    i = 0
     for x, y in points_2d:
-        flat.extend([float(x), float(y), 0.0])
-    return flat
+        buf[i] = x
+        buf[i + 1] = y
+        i += 3
+    return buf
+
+def _use_sendcommand() -> bool:
+    """Опт-ин на командный скрипт: AGENT_CAD_SENDCOMMAND=1."""
+    return os.getenv("AGENT_CAD_SENDCOMMAND", "").lower() in ("1", "true", "yes")
+
+def _fmt_coord(v: float) -> str:
+    """Координата для командной строки: фиксированная точка — научную
+    запись вида 1e-06 из f-строки командная строка не принимает."""
+    return f"{float(v):.8f}"
+
+def _sendcommand_commit(acad, primitives: List[tuple]) -> int:
+    """Пачка примитивов одной строкой SendCommand.
+
+    _non перед каждой вводимой точкой глушит объектные привязки (иначе
+    включённый по умолчанию osnap утаскивает центр к соседней геометрии).
+    SendCommand — fire-and-forget, поэтому результат меряем дельтой
+    числа сущностей и бросаем исключение при недоборе.
+    """
+    ms = _ms()
+    before = int(ms.Count)
+    parts: List[str] = []
+    for p in primitives:
+        kind = p[0]
+        if kind == "circle":
+            _, cx, cy, r = p
+            parts.append(f"_CIRCLE _non {_fmt_coord(cx)},{_fmt_coord(cy)} {_fmt_coord(r)}\n")
+        elif kind == "line":
+            _, x1, y1, x2, y2 = p
+            parts.append(f"_LINE _non {_fmt_coord(x1)},{_fmt_coord(y1)} "
+                         f"_non {_fmt_coord(x2)},{_fmt_coord(y2)}\n\n")
+        elif kind == "rect":
+            _, x1, y1, x2, y2 = p
+            parts.append(f"_RECTANG _non {_fmt_coord(x1)},{_fmt_coord(y1)} "
+                         f"_non {_fmt_coord(x2)},{_fmt_coord(y2)}\n")
+        else:
+            raise ValueError(f"unknown primitive: {kind}")
+    acad.doc.SendCommand("".join(parts))
+    _invalidate_ms_cache()
+    inserted = max(0, int(ms.Count) - before)
+    if inserted < len(primitives):
+        raise RuntimeError(f"sendcommand inserted {inserted}/{len(primitives)}")
+    return inserted
+
+def _bulk_draw_commit(primitives: List[tuple], layer: str | None = None) -> int:
+    """Нарисовать пачку примитивов одной операцией.
+
+    Примитивы: ("circle", cx, cy, r), ("line", x1, y1, x2, y2),
+    ("rect", x1, y1, x2, y2). По умолчанию — серия Add* под общим
+    undo-маркером: каждый вызов возвращает результат, счётчик честный
+    и слой ставится явно. Командный скрипт (_sendcommand_commit) —
+    только по опт-ину: он быстрее, но рисует в текущий слой.
+    """
+    if not primitives:
+        return 0
+    if _use_ezdxf():
+        msp = _ezdxf_msp()
+        attribs = {"layer": layer} if layer else None
+        for p in primitives:
+            kind = p[0]
+            if kind == "circle":
+                msp.add_circle((p[1], p[2]), p[3], dxfattribs=attribs)
+            elif kind == "line":
+                msp.add_line((p[1], p[2]), (p[3], p[4]), dxfattribs=attribs)
+            elif kind == "rect":
+                _, x1, y1, x2, y2 = p
+                msp.add_lwpolyline([(x1, y1), (x2, y1), (x2, y2), (x1, y2)],
+                                   close=True, dxfattribs=attribs)
+            else:
+                raise ValueError(f"unknown primitive: {kind}")
+        return len(primitives)
+    acad = _get_acad()
+    if _use_sendcommand():
+        try:
+            return _sendcommand_commit(acad, primitives)
+        except ValueError:
+            raise
+        except Exception:
+            pass  # скрипт не прошёл (заблокированный слой и т.п.) — COM-путь
+    inserted = 0
+    with _batch_draw():
+        for p in primitives:
+            kind = p[0]
+            try:
+                if kind == "circle":
+                    draw_circle((p[1], p[2]), p[3], layer=layer)
+                elif kind == "line":
+                    draw_line((p[1], p[2]), (p[3], p[4]), layer=layer)
+                elif kind == "rect":
+                    _, x1, y1, x2, y2 = p
+                    draw_rectangle((x1, y1), x2 - x1, y2 - y1, layer=layer)
+                else:
+                    raise ValueError(f"unknown primitive: {kind}")
+                inserted += 1
+            except ValueError:
+                raise
+            except Exception:
+                pass  # не спотыкаемся об одну неудачную сущность
+    return inserted
+
+@contextlib.contextmanager
+def _batch_draw():
+    """Серия рисовалок как одна операция: один undo-маркер на всю пачку
+    (AutoCAD не плодит undo-записи на каждую сущность) и один сброс
+    снимка ModelSpace в конце вместо сброса на каждый Add*."""
+    if _use_ezdxf():
+        yield _ezdxf_msp()  # офлайн-документу не нужны ни undo-маркеры, ни снимок
+        return
+    doc = _doc()
+    try:
+        doc.StartUndoMark()
+    except Exception:
+        pass
+    try:
+        yield _ms()
+    finally:
+        try:
+            doc.EndUndoMark()
+        except Exception:
+            pass
+        _invalidate_ms_cache()
 
 def draw_line(start: Tuple[float, float], end: Tuple[float, float], layer: str | None = None, **kwargs):
+    if _use_ezdxf():
+        e = _ezdxf_msp().add_line(
+            (float(start[0]), float(start[1])), (float(end[0]), float(end[1])),
+            dxfattribs={"layer": layer} if layer else None)
+        return {"ok": True, "handle": str(e.dxf.handle)}
     ms = _ms()
     e = ms.AddLine(APoint(float(start[0]), float(start[1])),
                    APoint(float(end[0]), float(end[1])))
     if layer:
         e.Layer = layer
-    time.sleep(0.02)
+    _invalidate_ms_cache()
     return {"ok": True, "handle": getattr(e, "Handle", None)}
 
 def draw_polyline(points: List[Tuple[float, float]],
@@ -334,15 +676,21 @@ def draw_polyline(points: List[Tuple[float, float]],
     pts = list(points)
     if closed and pts and _dist(pts[0], pts[-1]) > _POS_TOL:
         pts.append(pts[0])
+    if _use_ezdxf():
+        pl = _ezdxf_msp().add_lwpolyline(
+            [(float(x), float(y)) for x, y in pts], close=closed,
+            dxfattribs={"layer": layer} if layer else None)
+        return {"ok": True, "handle": str(pl.dxf.handle)}
     ms = _ms()
     flat3d = _to_3d_flat(pts)
-    pl = ms.AddPolyline(aDouble(*flat3d))
+    pl = ms.AddPolyline(aDouble(flat3d))
     try:
         pl.Closed = closed
     except Exception:
         pass
     if layer:
         pl.Layer = layer
+    _invalidate_ms_cache()
     return {"ok": True, "handle": getattr(pl, "Handle", None)}
 
 def draw_rectangle(base: Tuple[float, float], width: float, height: float, layer: str | None = None, **kwargs):
@@ -352,21 +700,44 @@ def draw_rectangle(base: Tuple[float, float], width: float, height: float, layer
     return draw_polyline(pts, layer=layer, closed=True)
 
 def draw_circle(center: Tuple[float, float], radius: float, layer: str | None = None, **kwargs):
+    if _use_ezdxf():
+        c = _ezdxf_msp().add_circle(
+            (float(center[0]), float(center[1])), float(radius),
+            dxfattribs={"layer": layer} if layer else None)
+        return {"ok": True, "handle": str(c.dxf.handle)}
     ms = _ms()
     c = ms.AddCircle(APoint(float(center[0]), float(center[1])), float(radius))
     if layer:
         c.Layer = layer
+    _invalidate_ms_cache()
     return {"ok": True, "handle": getattr(c, "Handle", None)}
 
 def zoom_extents(**kwargs):
+    if _use_ezdxf():
+        return {"ok": True}  # офлайн-документу зумить нечего
     acad = _get_acad()
-    time.sleep(0.2)
-    acad.app.ZoomExtents()
-    return {"ok": True}
+    # раньше тут был слепой sleep(0.2); если AutoCAD занят, он сам
+    # вернёт «call rejected» — ретраим с коротким бэкоффом, как в
+    # get_current_doc_info, вместо безусловной паузы
+    last_err = None
+    for attempt in range(5):
+        try:
+            acad.app.ZoomExtents()
+            return {"ok": True}
+        except Exception as ex:
+            last_err = ex
+            time.sleep(0.05 * (attempt + 1))
+    return {"ok": False, "reason": f"zoom_failed: {last_err}"}
 
 def save_as(path: str, **kwargs):
+    if _use_ezdxf():
+        _ezdxf_msp()
+        _EZDXF_DOC.saveas(path)
+        return {"ok": True, "path": path}
     acad = _get_acad()
     acad.doc.SaveAs(path)
+    _invalidate_ms_cache()
+    _invalidate_doc_cache()  # SaveAs меняет имя документа
     return {"ok": True, "path": path}
 
 # =====================================================
@@ -418,23 +789,36 @@ def list_layers(limit: int | None = None, **kwargs) -> Dict[str, Dict[str, Any]]
         }
     return {"ok": True, "layers": layers}
 
+def list_layer_names(**kwargs) -> Dict[str, Any]:
+    """Только имена слоёв: одно свойство на слой вместо четырёх в list_layers.
+    Итерация по коллекции — одна COM-энумерация, без Item(i) на каждый индекс."""
+    acad = _get_acad()
+    names = []
+    try:
+        for l in acad.doc.Layers:
+            names.append(l.Name)
+    except Exception:
+        # не все хосты отдают коллекцию итератором — fallback на индексы
+        for i in range(acad.doc.Layers.Count):
+            names.append(acad.doc.Layers.Item(i).Name)
+    return {"ok": True, "names": names}
+
 def list_entities(limit: int = 100,
                   layer: str | None = None,
                   type_contains: str | None = None,
                   **kwargs):
-    ms = _ms()
     res = []
     count = 0
     type_filter = (type_contains or "").lower()
-    for e in ms:
-        if layer and getattr(e, "Layer", None) != layer:
+    for e, nm, e_layer, handle, _geo in _ms_cached():
+        if layer and e_layer != layer:
             continue
-        if type_filter and type_filter not in _object_name(e).lower():
+        if type_filter and type_filter not in nm:
             continue
         res.append({
-            "handle": getattr(e, "Handle", None),
+            "handle": handle,
             "type": _object_name(e),
-            "layer": getattr(e, "Layer", None),
+            "layer": e_layer,
         })
         count += 1
         if count >= limit:
@@ -443,22 +827,48 @@ def list_entities(limit: int = 100,
 
 def get_extents_of_model(**kwargs):
     """Границы модели по типовым объектам (Polyline/Line/Circle); если совсем пусто — ok=False."""
-    ms = _ms()
-    minx = miny = float("inf")
-    maxx = maxy = float("-inf")
-    any_found = False
+    # быстрый путь: AutoCAD сам ведёт экстенты как системные переменные
+    # EXTMIN/EXTMAX — одно чтение вместо обхода всех сущностей. Но они
+    # пересчитываются только на ZOOM Extents/сохранении: после erase_*
+    # там лежат старые, слишком широкие границы. DBMOD != 0 означает
+    # «чертёж менялся с последнего сохранения» — тогда переменным верить
+    # нельзя и считаем по сущностям.
+    try:
+        acad = _get_acad()
+        dirty = True
+        try:
+            dirty = bool(int(acad.doc.GetVariable("DBMOD")))
+        except Exception:
+            pass  # не смогли проверить — считаем грязным
+        if not dirty:
+            emin = acad.doc.GetVariable("EXTMIN")
+            emax = acad.doc.GetVariable("EXTMAX")
+            minx, miny = float(emin[0]), float(emin[1])
+            maxx, maxy = float(emax[0]), float(emax[1])
+            # в пустом чертеже AutoCAD держит там +/-1e20 — признак «нет данных»
+            if minx <= maxx and miny <= maxy and abs(minx) < 1e19 and abs(maxy) < 1e19:
+                return {"ok": True,
+                        "min": (minx, miny),
+                        "max": (maxx, maxy),
+                        "center": ((minx + maxx) / 2.0, (miny + maxy) / 2.0)}
+    except Exception:
+        pass
 
-    for e in ms:
+    # запасной путь: фолдим bbox'ы сущностей (одним np.min/np.max по пачке)
+    boxes = []
+    for e, _nm, _layer, _handle, _geo in _ms_cached():
         bbox = _get_bbox_entity(e)
         if bbox:
-            any_found = True
             (x1, y1, _), (x2, y2, _) = bbox
-            minx, miny = min(minx, x1), min(miny, y1)
-            maxx, maxy = max(maxx, x2), max(maxy, y2)
+            boxes.append((x1, y1, x2, y2))
 
-    if not any_found:
+    if not boxes:
         return {"ok": False, "reason": "no_entities"}
 
+    arr = np.asarray(boxes, dtype=np.float64)
+    minx, miny = float(arr[:, 0].min()), float(arr[:, 1].min())
+    maxx, maxy = float(arr[:, 2].max()), float(arr[:, 3].max())
+
     return {"ok": True,
             "min": (minx, miny),
             "max": (maxx, maxy),
@@ -477,7 +887,7 @@ def snapshot_model(limit: int = 20,
     """Снимок контекста: документ, экстенты, слои (имена) и N объектов (тип/слой/handle)."""
     doc = get_current_doc_info()
     ext = get_extents_of_model()
-    layers = list(list_layers().get("layers", {}).keys())
+    layers = list_layer_names().get("names", [])
     ents = list_entities(limit=limit, layer=layer, type_contains=type_contains).get("entities", [])
     return {
         "ok": True,
@@ -500,7 +910,11 @@ def _find_loops_from_lines(lines: List[Dict[str, Any]],
     # извлекаем сегменты
     segs: List[Tuple[Tuple[float, float], Tuple[float, float]]] = []
     for d in lines:
-        e = d["entity"]
+        seg = d.get("seg")
+        if seg is not None:
+            segs.append(seg)
+            continue
+        e = d.get("entity")
         try:
             sp = e.StartPoint; ep = e.EndPoint
             p1 = (float(sp[0]), float(sp[1]))
@@ -509,76 +923,137 @@ def _find_loops_from_lines(lines: List[Dict[str, Any]],
         except Exception:
             continue
 
-    # граф по точкам (схлопнем близкие точки)
-    # нормализатор точки
-    def key_pt(p):
-        return (round(p[0]/pos_tol)*pos_tol, round(p[1]/pos_tol)*pos_tol)
-
-    adj: Dict[Tuple[float,float], Set[Tuple[float,float]]] = {}
+    # Схлопывание близких концов через целочисленную решётку: раньше
+    # round(p/tol)*tol мог развести совпадающие точки по соседним ячейкам
+    # на границе; теперь смотрим ячейку точки и 8 соседних. Вершины графа —
+    # целые id (их хэш заметно дешевле кортежа float).
+    inv_tol = 1.0 / pos_tol
+    pts: List[Tuple[float, float]] = []
+    cell_pts: Dict[Tuple[int, int], List[int]] = {}
+
+    def point_id(p: Tuple[float, float]) -> int:
+        x, y = p
+        ix, iy = int(math.floor(x * inv_tol)), int(math.floor(y * inv_tol))
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for i in cell_pts.get((ix + dx, iy + dy), ()):
+                    px, py = pts[i]
+                    if abs(px - x) <= pos_tol and abs(py - y) <= pos_tol:
+                        return i
+        i = len(pts)
+        pts.append((x, y))
+        adj.append([])
+        cell_pts.setdefault((ix, iy), []).append(i)
+        return i
+
+    # соседи — плотные списки (итерация дешевле, чем по set);
+    # дедуп рёбер — отдельным set канонических пар id
+    adj: List[List[int]] = []
+    seen_edges: Set[Tuple[int, int]] = set()
     for p1, p2 in segs:
-        k1, k2 = key_pt(p1), key_pt(p2)
-        adj.setdefault(k1, set()).add(k2)
-        adj.setdefault(k2, set()).add(k1)
-
-    loops: Set[Tuple[Tuple[float,float], ...]] = set()
-
-    # для каждого ребра — попробуем обойти цикл длиной 4
-    for p1, p2 in segs:
-        k1, k2 = key_pt(p1), key_pt(p2)
-        # все соседи k2 (кроме k1)
-        for k3 in adj.get(k2, []):
-            if k3 == k1:
-                continue
-            # соседи k3, кроме k2
-            for k4 in adj.get(k3, []):
-                if k4 in (k2, k1):
+        i1 = point_id(p1)
+        i2 = point_id(p2)
+        if i1 == i2:
+            continue
+        ek = (i1, i2) if i1 < i2 else (i2, i1)
+        if ek in seen_edges:
+            continue
+        seen_edges.add(ek)
+        adj[i1].append(i2)
+        adj[i2].append(i1)
+
+    # Все 4-циклы через общих соседей: вершина v с парой соседей (a, b)
+    # образует «уголок» a–v–b; две разные вершины с одним уголком замыкают
+    # четырёхугольник a–v–b–x. Перебор пар соседей дёшев (степени вершин
+    # в чертежах из линий малы) и, в отличие от фундаментальных циклов
+    # остовного дерева, находит и смежные квадраты с общими рёбрами.
+    n = len(pts)
+    loops: Set[Tuple[int, ...]] = set()
+    corners: Dict[Tuple[int, int], List[int]] = {}
+
+    def canon(cycle: List[int]) -> Tuple[int, ...]:
+        """Канонизация цикла: старт с минимальной вершины, фикс. ориентация."""
+        i = cycle.index(min(cycle))
+        rot = cycle[i:] + cycle[:i]
+        rev = [rot[0]] + rot[1:][::-1]
+        return tuple(min(rot, rev))
+
+    for v in range(n):
+        nbrs = adj[v]
+        for i in range(len(nbrs)):
+            a = nbrs[i]
+            for j in range(i + 1, len(nbrs)):
+                b = nbrs[j]
+                key = (a, b) if a < b else (b, a)
+                mates = corners.get(key)
+                if mates is None:
+                    corners[key] = [v]
                     continue
-                # замыкается ли на k1?
-                if k1 in adj.get(k4, []):
-                    quad = [k1, k2, k3, k4]
-                    # нормализуем порядок (чтобы не ловить дубликаты)
-                    # сдвинем так, чтобы минимальная лексикографически точка была первой
-                    min_i = min(range(4), key=lambda i: quad[i])
-                    ordered = quad[min_i:] + quad[:min_i]
-                    loops.add(tuple(ordered))
-
-    # преобразуем в списки «реальных» точек (ключи уже округлены)
-    res: List[List[Tuple[float, float]]] = []
-    for loop in loops:
-        pts = [(float(x), float(y)) for (x, y) in loop]
-        pts = _order_loop(pts)
-        res.append(pts)
-    return res
+                for x in mates:
+                    loops.add(canon([key[0], v, key[1], x]))
+                mates.append(v)
+
+    # id → реальные координаты (первая встреченная точка кластера)
+    return [[pts[i] for i in loop] for loop in loops]
 
 def find_closed_polylines(layer: str | None = None,
                           min_vertices: int = 3,
                           min_area: float = 0.0,
+                          pick_largest: bool = False,
                           **kwargs):
-    """Найти замкнутые полилинии (Polyline/LWPolyline). Возвращает вершины и bbox."""
-    ms = _ms()
-    found = []
-    for e in ms:
-        name = _object_name(e)
-        if "polyline" not in name.lower():
+    """Найти замкнутые полилинии (Polyline/LWPolyline). Возвращает вершины и bbox.
+    pick_largest=True — держим только текущий максимум по площади (O(1) памяти)."""
+    # 1) COM-фаза: только сбор вершин
+    metas: List[Tuple[Any, Any, List[Tuple[float, float]]]] = []
+    for e, nm, e_layer, handle, _geo in _ms_cached():
+        if "polyline" not in nm:
             continue
-        if layer and getattr(e, "Layer", None) != layer:
+        if layer and e_layer != layer:
             continue
         if not _polyline_is_closed(e):
             continue
         verts2 = _polyline_vertices_2d_ordered(e)
         if len(verts2) < min_vertices:
             continue
-        area = _poly_area_xy(verts2)
+        metas.append((handle, e_layer, verts2))
+
+    if not metas:
+        return {"ok": True, "polylines": []}
+
+    # 2) числовая фаза: площади (shoelace) и bbox всех контуров разом —
+    # reduceat по плоскому массиву вершин с офсетами контуров
+    counts = np.array([len(v) for _, _, v in metas], dtype=np.intp)
+    offsets = np.zeros(len(counts), dtype=np.intp)
+    np.cumsum(counts[:-1], out=offsets[1:])
+    flat = np.asarray([pt for _, _, v in metas for pt in v], dtype=np.float64)
+    nxt = np.arange(1, len(flat) + 1, dtype=np.intp)
+    nxt[offsets + counts - 1] = offsets  # последняя вершина замыкается на первую
+    cross = flat[:, 0] * flat[nxt, 1] - flat[nxt, 0] * flat[:, 1]
+    areas = np.abs(np.add.reduceat(cross, offsets)) / 2.0
+    mins = np.minimum.reduceat(flat, offsets, axis=0)
+    maxs = np.maximum.reduceat(flat, offsets, axis=0)
+
+    found = []
+    best = None
+    for i, (handle, e_layer, verts2) in enumerate(metas):
+        area = float(areas[i])
         if area < min_area:
             continue
-        bbox = _bbox_from_points_2d(verts2)
-        found.append({
-            "handle": getattr(e, "Handle", None),
-            "layer": getattr(e, "Layer", None),
+        item = {
+            "handle": handle,
+            "layer": e_layer,
             "vertices": verts2,
             "area": area,
-            "bbox": bbox,
-        })
+            "bbox": ((float(mins[i, 0]), float(mins[i, 1])),
+                     (float(maxs[i, 0]), float(maxs[i, 1]))),
+        }
+        if pick_largest:
+            if best is None or area > best["area"]:
+                best = item
+        else:
+            found.append(item)
+    if pick_largest:
+        found = [best] if best is not None else []
     return {"ok": True, "polylines": found}
 
 def find_squares(layer: str | None = None,
@@ -605,71 +1080,103 @@ def find_squares(layer: str | None = None,
       "bbox": ((minx,miny),(maxx,maxy))
     }
     """
-    ms = _ms()
-    squares: List[Dict[str, Any]] = []
+    seen_keys: Set[tuple] = set()
+
+    def _validate(candidates: List[Dict[str, Any]], need: int) -> List[Dict[str, Any]]:
+        """Векторизованный тест пачки кандидатов (N,4,2), не больше need штук."""
+        if not candidates or need <= 0:
+            return []
+        verts_arr = np.asarray([c["vertices"] for c in candidates], dtype=np.float64)
+
+        def quad_mask(part: np.ndarray) -> np.ndarray:
+            return _batch_quad_mask(part,
+                                    ang_tol_deg=ang_tol_deg,
+                                    rel_len_tol=rel_len_tol,
+                                    min_side=min_side,
+                                    allow_rectangles=allow_rectangles)
+
+        # гигантские пачки режем по потокам: кандидаты — уже чистые float-массивы
+        # (COM остался в снимке), а NumPy отпускает GIL на крупных операциях
+        if len(verts_arr) >= 2 * _PAR_CHUNK:
+            parts = [verts_arr[i:i + _PAR_CHUNK]
+                     for i in range(0, len(verts_arr), _PAR_CHUNK)]
+            with ThreadPoolExecutor(max_workers=min(len(parts), os.cpu_count() or 2)) as pool:
+                mask = np.concatenate(list(pool.map(quad_mask, parts)))
+        else:
+            mask = quad_mask(verts_arr)
+        # центры и стороны — тоже батчем, без поштучного _centroid/_dist
+        centers = _batch_centroids(verts_arr)
+        lens = np.linalg.norm(np.roll(verts_arr, -1, axis=1) - verts_arr, axis=2)
+        sides_min = np.minimum(lens[:, 0], lens[:, 1])
+        out: List[Dict[str, Any]] = []
+        for i, (cand, good) in enumerate(zip(candidates, mask)):
+            if not good:
+                continue
+            # один и тот же квадрат может прийти и как полилиния, и как
+            # 4 LINE — дедупим по квантованному набору вершин
+            key = tuple(sorted((round(x / pos_tol), round(y / pos_tol))
+                               for x, y in cand["vertices"]))
+            if key in seen_keys:
+                continue
+            seen_keys.add(key)
+            cand["center"] = (float(centers[i, 0]), float(centers[i, 1]))
+            cand["side"] = float(sides_min[i])
+            out.append(cand)
+            if len(out) >= need:
+                break
+        return out
 
-    # 1) Полилинии
+    # 1) дешёвая фаза: замкнутые полилинии; если они уже закрыли max_count,
+    # дорогой проход по LINE-циклам вообще не запускаем
+    poly_candidates: List[Dict[str, Any]] = []
     polys = find_closed_polylines(layer=layer, min_vertices=4, min_area=min_side*min_side).get("polylines", [])
     for poly in polys:
         vs = poly["vertices"]
-        if len(vs) == 4 and (
-            _is_square_vertices(vs, ang_tol_deg=ang_tol_deg, rel_len_tol=rel_len_tol, min_side=min_side) or
-            (allow_rectangles and _is_rectangle_vertices(vs, ang_tol_deg=ang_tol_deg, rel_len_tol=rel_len_tol, min_side=min_side))
-        ):
-            center = _centroid(vs)
-            side = min(_dist(vs[0], vs[1]), _dist(vs[1], vs[2]))
-            squares.append({
+        if len(vs) == 4:
+            poly_candidates.append({
                 "source": "polyline",
                 "handles": [poly["handle"]],
                 "vertices": vs,
-                "center": center,
-                "side": side,
-                "bbox": poly["bbox"]
+                "bbox": poly["bbox"],
             })
-            if len(squares) >= max_count:
-                return {"ok": True, "squares": squares}
 
-    # 2) Ломаные из LINE
-    if include_lines:
+    squares = _validate(poly_candidates, max_count)
+
+    if include_lines and len(squares) < max_count:
         # соберём все линии (и по нужному слою, если задан)
         line_datas: List[Dict[str, Any]] = []
-        for e in ms:
-            if layer and getattr(e, "Layer", None) != layer:
+        for e, nm, e_layer, handle, geo in _ms_cached():
+            if layer and e_layer != layer:
                 continue
-            nm = _object_name(e).lower()
             if "line" in nm and "polyline" not in nm:
-                line_datas.append({"entity": e, "handle": getattr(e, "Handle", None)})
+                line_datas.append({"entity": e, "handle": handle, "seg": geo})
 
+        # циклы собираем все: бюджет max_count расходуют только
+        # ПРОВЕРЕННЫЕ квадраты (внутри _validate), иначе каждый
+        # не-квадратный контур съедал бы место настоящего
+        remaining = max_count - len(squares)
         loops = _find_loops_from_lines(line_datas, pos_tol=pos_tol)
+        line_candidates: List[Dict[str, Any]] = []
         for vs in loops:
-            if len(vs) == 4 and (
-                _is_square_vertices(vs, ang_tol_deg=ang_tol_deg, rel_len_tol=rel_len_tol, min_side=min_side) or
-                (allow_rectangles and _is_rectangle_vertices(vs, ang_tol_deg=ang_tol_deg, rel_len_tol=rel_len_tol, min_side=min_side))
-            ):
-                center = _centroid(vs)
-                side = min(_dist(vs[0], vs[1]), _dist(vs[1], vs[2]))
-                bbox = _bbox_from_points_2d(vs)
+            if len(vs) == 4:
                 # handles для линий — не трекаем точно какие 4 дали этот луп (дорого),
                 # но можно приблизительно собрать любые 4, которые соединяются в эти вершины (упрощённо пропустим)
-                squares.append({
+                line_candidates.append({
                     "source": "lines",
                     "handles": [],
                     "vertices": vs,
-                    "center": center,
-                    "side": side,
-                    "bbox": bbox
+                    "bbox": _bbox_from_points_2d(vs),
                 })
-                if len(squares) >= max_count:
-                    return {"ok": True, "squares": squares}
+        squares.extend(_validate(line_candidates, remaining))
 
     return {"ok": True, "squares": squares}
 
 def pick_largest_closed_polyline(layer: str | None = None, **kwargs):
-    res = find_closed_polylines(layer=layer, min_vertices=3, min_area=_MIN_SIDE * _MIN_SIDE)
+    res = find_closed_polylines(layer=layer, min_vertices=3, min_area=_MIN_SIDE * _MIN_SIDE,
+                                pick_largest=True)
     polys = res.get("polylines", [])
     if not polys:
         return {"ok": False, "reason": "no_closed_polylines"}
-    polys.sort(key=lambda p: p.get("area", 0.0), reverse=True)
     return {"ok": True, "polyline": polys[0]}
 
 def measure_bbox_of_largest_closed(layer: str | None = None, **kwargs):
@@ -717,7 +1224,10 @@ def inscribe_circles_in_squares(layer_name: str = "CIRCLES_YELLOW",
     if not found.get("ok"):
         return {"ok": False, "reason": "find_squares_failed"}
 
-    inserted = 0
+    # сначала считаем всю пачку (cx,cy,r), потом льём её в AutoCAD одной
+    # серией AddCircle под общим undo-маркером — без per-круг обвязки draw_circle
+    jobs: List[Tuple[float, float, float]] = []
+    seen: Set[Tuple[int, int, int]] = set()
     for sq in found["squares"]:
         c = sq["center"]
         # радиус по короткой стороне
@@ -728,13 +1238,18 @@ def inscribe_circles_in_squares(layer_name: str = "CIRCLES_YELLOW",
             ) / 2.0
         except Exception:
             r = sq.get("side", 0.0) / 2.0
-        try:
-            draw_circle(c, r, layer=layer_name)
-            inserted += 1
-        except Exception:
-            # не спотыкаемся об один неудачный круг
-            pass
+        cx, cy, r = float(c[0]), float(c[1]), float(r)
+        # совпадающие квадраты дают совпадающие круги — не дублируем сущности
+        key = (round(cx / pos_tol), round(cy / pos_tol), round(r / pos_tol))
+        if key in seen:
+            continue
+        seen.add(key)
+        jobs.append((cx, cy, r))
 
+    # вся пачка одной операцией; слой передаём явно — даже если
+    # set_current_layer выше не сработал, круги лягут куда обещано
+    inserted = _bulk_draw_commit(
+        [("circle", cx, cy, r) for cx, cy, r in jobs], layer=layer_name)
     return {"ok": True, "inserted": inserted, "layer": layer_name}
 
 def inscribe_squares_in_circles(layer_name: str = "CIRCLES_YELLOW",
@@ -752,28 +1267,23 @@ def inscribe_squares_in_circles(layer_name: str = "CIRCLES_YELLOW",
     except Exception:
         pass
 
-    ms = _ms()
-    inserted = 0
-    for e in ms:
-        nm = _object_name(e).lower()
-        if "circle" not in nm:
-            continue
-        if layer_filter and getattr(e, "Layer", None) != layer_filter:
+    jobs: List[Tuple[Tuple[float, float], float]] = []
+    for _e, nm, e_layer, _handle, geo in _ms_cached():
+        if "circle" not in nm or geo is None:
             continue
-        try:
-            c = e.Center
-            r = float(e.Radius)
-            cx, cy = float(c[0]), float(c[1])
-            half = r / math.sqrt(2.0)
-            base = (cx - half, cy - half)
-            size = half * 2.0
-            draw_rectangle(base, size, size, layer=layer_name)
-            inserted += 1
-            if inserted >= max_count:
-                break
-        except Exception:
+        if layer_filter and e_layer != layer_filter:
             continue
+        (cx, cy), r = geo
+        half = r / math.sqrt(2.0)
+        jobs.append(((cx - half, cy - half), half * 2.0))
+        if len(jobs) >= max_count:
+            break
 
+    # вся пачка одной операцией, слой — явно
+    inserted = _bulk_draw_commit([
+        ("rect", base[0], base[1], base[0] + size, base[1] + size)
+        for base, size in jobs
+    ], layer=layer_name)
     return {"ok": True, "inserted": inserted, "layer": layer_name}
 
 def draw_triangle_roof_over_largest_square(layer_source: str | None = None,
@@ -826,43 +1336,54 @@ def draw_triangle_roof_over_largest_square(layer_source: str | None = None,
 def find_circles(layer: str | None = None,
                  min_radius: float = 0.0,
                  max_count: int = 5000,
+                 pick_largest: bool = False,
                  **kwargs):
-    """Найти окружности с центром/радиусом и bbox."""
-    ms = _ms()
-    circles = []
-    for e in ms:
-        nm = _object_name(e).lower()
-        if "circle" not in nm:
+    """Найти окружности с центром/радиусом и bbox.
+    pick_largest=True — держим только текущий максимум по радиусу (O(1) памяти)."""
+    min_radius = float(min_radius)
+    rows: List[Tuple[Any, Any, float, float, float]] = []
+    best = None
+    for _e, nm, e_layer, handle, geo in _ms_cached():
+        if "circle" not in nm or geo is None:
             continue
-        if layer and getattr(e, "Layer", None) != layer:
+        if layer and e_layer != layer:
             continue
-        try:
-            c = e.Center
-            r = float(e.Radius)
-            if r < float(min_radius):
-                continue
-            cx, cy = float(c[0]), float(c[1])
-            bbox = ((cx - r, cy - r), (cx + r, cy + r))
-            circles.append({
-                "handle": getattr(e, "Handle", None),
-                "layer": getattr(e, "Layer", None),
-                "center": (cx, cy),
-                "radius": r,
-                "bbox": bbox,
-            })
-            if len(circles) >= max_count:
-                break
-        except Exception:
+        (cx, cy), r = geo
+        if r < min_radius:
+            continue
+        if pick_largest:
+            if best is None or r > best[4]:
+                best = (handle, e_layer, cx, cy, r)
             continue
+        rows.append((handle, e_layer, cx, cy, r))
+        if len(rows) >= max_count:
+            break
+    if pick_largest:
+        rows = [best] if best is not None else []
+    if not rows:
+        return {"ok": True, "circles": []}
+
+    # bbox'ы всей пачки одним броадкастом вместо арифметики на каждый круг
+    arr = np.asarray([(cx, cy, r) for _, _, cx, cy, r in rows], dtype=np.float64)
+    bmin = arr[:, :2] - arr[:, 2:3]
+    bmax = arr[:, :2] + arr[:, 2:3]
+
+    circles = [{
+        "handle": handle,
+        "layer": e_layer,
+        "center": (cx, cy),
+        "radius": r,
+        "bbox": ((float(bmin[i, 0]), float(bmin[i, 1])),
+                 (float(bmax[i, 0]), float(bmax[i, 1]))),
+    } for i, (handle, e_layer, cx, cy, r) in enumerate(rows)]
     return {"ok": True, "circles": circles}
 
 def pick_largest_circle(layer: str | None = None, **kwargs):
     """Вернуть окружность с максимальным радиусом."""
-    res = find_circles(layer=layer)
+    res = find_circles(layer=layer, pick_largest=True)
     cs = res.get("circles", [])
     if not cs:
         return {"ok": False, "reason": "no_circles"}
-    cs.sort(key=lambda c: c.get("radius", 0.0), reverse=True)
     return {"ok": True, "circle": cs[0]}
 
 def make_snowman_from_circle(layer_source: str | None = None,
@@ -906,46 +1427,48 @@ def make_snowman_from_circle(layer_source: str | None = None,
     c_mid = (cx, cy + R + gap + R_mid)
     c_head = (cx, c_mid[1] + R_mid + gap + R_head)
 
-    draw_circle(c_base, R, layer=layer_result or layer_source)
-    draw_circle(c_mid, R_mid, layer=layer_result or layer_source)
-    draw_circle(c_head, R_head, layer=layer_result or layer_source)
-
-    # глазки
-    eye_r = max(R_head * float(eye_scale), _MIN_SIDE)
-    eye_dx = R_head * 0.3
-    eye_dy = R_head * 0.15
-    draw_circle((c_head[0] - eye_dx, c_head[1] + eye_dy), eye_r, layer=layer_result or layer_source)
-    draw_circle((c_head[0] + eye_dx, c_head[1] + eye_dy), eye_r, layer=layer_result or layer_source)
-
-    # ручки (веточки): по диагонали от средней сферы, плюс круглые ладошки
-    if draw_arms:
-        arm_len = R_mid * 1.2
-        up = R_mid * 0.3
-        # left
-        p1l = (c_mid[0] - R_mid * 0.9, c_mid[1] + up * 0.2)
-        p2l = (p1l[0] - arm_len, p1l[1] + up)
-        draw_line(p1l, p2l, layer=layer_result or layer_source)
-        draw_circle(p2l, max(R_head * float(hand_scale), _MIN_SIDE), layer=layer_result or layer_source)
-        # right
-        p1r = (c_mid[0] + R_mid * 0.9, c_mid[1] + up * 0.2)
-        p2r = (p1r[0] + arm_len, p1r[1] + up)
-        draw_line(p1r, p2r, layer=layer_result or layer_source)
-        draw_circle(p2r, max(R_head * float(hand_scale), _MIN_SIDE), layer=layer_result or layer_source)
-
-    # ножки (лапки): диагональные линии от низа базы и круглые стопы
-    if draw_legs:
-        leg_len = R * 0.7
-        base_y = c_base[1] - R
-        # left
-        l1 = (c_base[0] - R * 0.35, base_y + R * 0.2)
-        l2 = (l1[0] - R * 0.5, l1[1] - leg_len)
-        draw_line(l1, l2, layer=layer_result or layer_source)
-        draw_circle(l2, max(R * float(foot_scale), _MIN_SIDE), layer=layer_result or layer_source)
-        # right
-        r1 = (c_base[0] + R * 0.35, base_y + R * 0.2)
-        r2 = (r1[0] + R * 0.5, r1[1] - leg_len)
-        draw_line(r1, r2, layer=layer_result or layer_source)
-        draw_circle(r2, max(R * float(foot_scale), _MIN_SIDE), layer=layer_result or layer_source)
+    # вся фигура — одна операция: общий undo-маркер и один сброс снимка
+    with _batch_draw():
+        draw_circle(c_base, R, layer=layer_result or layer_source)
+        draw_circle(c_mid, R_mid, layer=layer_result or layer_source)
+        draw_circle(c_head, R_head, layer=layer_result or layer_source)
+
+        # глазки
+        eye_r = max(R_head * float(eye_scale), _MIN_SIDE)
+        eye_dx = R_head * 0.3
+        eye_dy = R_head * 0.15
+        draw_circle((c_head[0] - eye_dx, c_head[1] + eye_dy), eye_r, layer=layer_result or layer_source)
+        draw_circle((c_head[0] + eye_dx, c_head[1] + eye_dy), eye_r, layer=layer_result or layer_source)
+
+        # ручки (веточки): по диагонали от средней сферы, плюс круглые ладошки
+        if draw_arms:
+            arm_len = R_mid * 1.2
+            up = R_mid * 0.3
+            # left
+            p1l = (c_mid[0] - R_mid * 0.9, c_mid[1] + up * 0.2)
+            p2l = (p1l[0] - arm_len, p1l[1] + up)
+            draw_line(p1l, p2l, layer=layer_result or layer_source)
+            draw_circle(p2l, max(R_head * float(hand_scale), _MIN_SIDE), layer=layer_result or layer_source)
+            # right
+            p1r = (c_mid[0] + R_mid * 0.9, c_mid[1] + up * 0.2)
+            p2r = (p1r[0] + arm_len, p1r[1] + up)
+            draw_line(p1r, p2r, layer=layer_result or layer_source)
+            draw_circle(p2r, max(R_head * float(hand_scale), _MIN_SIDE), layer=layer_result or layer_source)
+
+        # ножки (лапки): диагональные линии от низа базы и круглые стопы
+        if draw_legs:
+            leg_len = R * 0.7
+            base_y = c_base[1] - R
+            # left
+            l1 = (c_base[0] - R * 0.35, base_y + R * 0.2)
+            l2 = (l1[0] - R * 0.5, l1[1] - leg_len)
+            draw_line(l1, l2, layer=layer_result or layer_source)
+            draw_circle(l2, max(R * float(foot_scale), _MIN_SIDE), layer=layer_result or layer_source)
+            # right
+            r1 = (c_base[0] + R * 0.35, base_y + R * 0.2)
+            r2 = (r1[0] + R * 0.5, r1[1] - leg_len)
+            draw_line(r1, r2, layer=layer_result or layer_source)
+            draw_circle(r2, max(R * float(foot_scale), _MIN_SIDE), layer=layer_result or layer_source)
 
     return {"ok": True, "base_circle": base}
 
@@ -956,11 +1479,10 @@ def copy_all_on_layer_by_offset(source_layer: str,
                                 limit: int | None = None,
                                 **kwargs):
     """Дублирует все объекты слоя source_layer со смещением (dx,dy). Опционально меняет слой у копий."""
-    ms = _ms()
     copied = 0
-    for e in ms:
+    for e, _nm, e_layer, _handle, _geo in _ms_cached():
         try:
-            if getattr(e, "Layer", None) != source_layer:
+            if e_layer != source_layer:
                 continue
             if limit is not None and copied >= int(limit):
                 break
@@ -986,6 +1508,8 @@ def copy_all_on_layer_by_offset(source_layer: str,
             copied += 1
         except Exception:
             continue
+    if copied:
+        _invalidate_ms_cache()
     return {"ok": True, "copied": copied}
 
 def draw_from_model_center(shape: str = "circle",
@@ -1008,40 +1532,106 @@ def draw_from_model_center(shape: str = "circle",
 # УДАЛЕНИЕ / ОЧИСТКА
 # =====================================================
 
+def _fresh_selection_set(doc, name: str):
+    """SelectionSet с таким именем мог остаться от прошлого вызова — чистим."""
+    try:
+        doc.SelectionSets.Item(name).Delete()
+    except Exception:
+        pass
+    return doc.SelectionSets.Add(name)
+
+def _dispatch_safearray(objs):
+    """SAFEARRAY из IDispatch для AddItems: обычный питоновский список
+    comtypes пакует как массив VARIANT'ов, и часть сборок AutoCAD такой
+    аргумент отвергает. Собираем массив нужного типа явно."""
+    import ctypes
+    from comtypes.automation import IDispatch
+    from comtypes.safearray import _midlSAFEARRAY
+    sa_type = _midlSAFEARRAY(ctypes.POINTER(IDispatch))
+    return sa_type.create([o.QueryInterface(IDispatch) for o in objs])
+
 def erase_by_handles(handles: List[str], **kwargs):
     acad = _get_acad()
-    count = 0
+    objs = []
     for h in handles:
         if not h:
             continue
         try:
-            e = acad.doc.HandleToObject(h)
-            e.Delete()
-            count += 1
+            objs.append(acad.doc.HandleToObject(h))
         except Exception:
             pass
+    if not objs:
+        return {"ok": True, "deleted": 0}
+
+    # быстрый путь: вся пачка одним SelectionSet.Erase вместо
+    # двух COM-вызовов (HandleToObject + Delete) на каждую сущность
+    count = 0
+    ss = None
+    try:
+        ss = _fresh_selection_set(acad.doc, "_tmp_erase")
+        try:
+            ss.AddItems(_dispatch_safearray(objs))
+        except Exception:
+            # comtypes недоступен или интерфейс не отдался — пробуем как есть
+            ss.AddItems(objs)
+        count = int(ss.Count)
+        ss.Erase()
+    except Exception:
+        # запасной путь: поштучное удаление (старое поведение)
+        count = 0
+        for e in objs:
+            try:
+                e.Delete()
+                count += 1
+            except Exception:
+                pass
+    finally:
+        if ss is not None:
+            try:
+                ss.Delete()
+            except Exception:
+                pass
+    if count:
+        _invalidate_ms_cache()
     return {"ok": True, "deleted": count}
 
 def erase_all_on_layer(layer: str, **kwargs):
-    ms = _ms()
-    handles = []
-    for e in ms:
-        if getattr(e, "Layer", None) == layer:
-            handles.append(getattr(e, "Handle", None))
-    return erase_by_handles(handles)
+    # быстрый путь: отбор по DXF-фильтру (8 = имя слоя) внутри AutoCAD,
+    # без итерации по снимку на питоне
+    acad = _get_acad()
+    ss = None
+    try:
+        ss = _fresh_selection_set(acad.doc, "_tmp_erase_layer")
+        # 5 = acSelectionSetAll; DXF-коды фильтра обязаны уйти как VT_I2:
+        # список питоновских int маршалится в VT_I4, и AutoCAD отвергает фильтр
+        ss.Select(5, None, None, array.array("h", [8]), [layer])
+        count = int(ss.Count)
+        ss.Erase()
+        if count:
+            _invalidate_ms_cache()
+        return {"ok": True, "deleted": count}
+    except Exception:
+        handles = [handle for _e, _nm, e_layer, handle, _geo in _ms_cached() if e_layer == layer]
+        return erase_by_handles(handles)
+    finally:
+        if ss is not None:
+            try:
+                ss.Delete()
+            except Exception:
+                pass
 
 def erase_by_filter(type_contains: str | None = None,
                     layer: str | None = None,
                     limit: Optional[int] = None,
                     **kwargs):
-    ms = _ms()
+    type_filter = (type_contains or "").lower()
     handles: List[str] = []
-    for e in ms:
-        if type_contains and type_contains.lower() not in _object_name(e).lower():
+    for _e, nm, e_layer, handle, _geo in _ms_cached():
+        if type_filter and type_filter not in nm:
             continue
-        if layer and getattr(e, "Layer", None) != layer:
+        if layer and e_layer != layer:
             continue
-        handles.append(getattr(e, "Handle", None))
+        handles.append(handle)
         if limit and len(handles) >= limit:
             break
     return erase_by_handles(handles)
@@ -1,34 +1,338 @@
+import ctypes
+import logging
+import threading
 import time
+from ctypes import wintypes
+
+import psutil
+import win32clipboard
 from pywinauto import Desktop
 from pywinauto.keyboard import send_keys
+from pywinauto.timings import Timings
+
+log = logging.getLogger(__name__)
+
+_user32 = ctypes.windll.user32
+_kernel32 = ctypes.windll.kernel32
+_dwmapi = ctypes.windll.dwmapi
+
+_PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+_DWMWA_CLOAKED = 14
+
+# WinEvent: ОС будит нас в момент появления/активации окна — вместо
+# перебора всех окон раз в полсекунды
+_EVENT_SYSTEM_FOREGROUND = 0x0003
+_EVENT_OBJECT_CREATE = 0x8000
+_EVENT_OBJECT_SHOW = 0x8002
+_WINEVENT_OUTOFCONTEXT = 0x0000
+_OBJID_WINDOW = 0
+_QS_ALLINPUT = 0x04FF
+_PM_REMOVE = 0x0001
+
+_WinEventProc = ctypes.WINFUNCTYPE(
+    None, wintypes.HANDLE, wintypes.DWORD, wintypes.HWND,
+    wintypes.LONG, wintypes.LONG, wintypes.DWORD, wintypes.DWORD)
+_WndEnumProc = ctypes.WINFUNCTYPE(wintypes.BOOL, wintypes.HWND, wintypes.LPARAM)
+
+def _declare(fn, restype, *argtypes):
+    fn.restype = restype
+    fn.argtypes = list(argtypes)
+
+# прототипы один раз на импорт: без argtypes ctypes угадывает тип каждого
+# аргумента при каждом вызове, а эти функции зовём десятки тысяч раз
+_declare(_user32.EnumWindows, wintypes.BOOL, _WndEnumProc, wintypes.LPARAM)
+_declare(_user32.GetForegroundWindow, wintypes.HWND)
+_declare(_user32.IsWindow, wintypes.BOOL, wintypes.HWND)
+_declare(_user32.IsWindowVisible, wintypes.BOOL, wintypes.HWND)
+_declare(_user32.GetWindowThreadProcessId, wintypes.DWORD,
+         wintypes.HWND, wintypes.LPDWORD)
+_declare(_user32.ShowWindow, wintypes.BOOL, wintypes.HWND, ctypes.c_int)
+_declare(_user32.SetForegroundWindow, wintypes.BOOL, wintypes.HWND)
+_declare(_user32.SendMessageTimeoutW, ctypes.c_ssize_t,
+         wintypes.HWND, wintypes.UINT, wintypes.WPARAM, wintypes.LPVOID,
+         wintypes.UINT, wintypes.UINT, ctypes.c_void_p)
+_declare(_user32.SetWinEventHook, wintypes.HANDLE,
+         wintypes.DWORD, wintypes.DWORD, wintypes.HMODULE, _WinEventProc,
+         wintypes.DWORD, wintypes.DWORD, wintypes.DWORD)
+_declare(_user32.UnhookWinEvent, wintypes.BOOL, wintypes.HANDLE)
+_declare(_user32.MsgWaitForMultipleObjects, wintypes.DWORD,
+         wintypes.DWORD, ctypes.c_void_p, wintypes.BOOL,
+         wintypes.DWORD, wintypes.DWORD)
+_declare(_user32.PeekMessageW, wintypes.BOOL,
+         ctypes.POINTER(wintypes.MSG), wintypes.HWND,
+         wintypes.UINT, wintypes.UINT, wintypes.UINT)
+_declare(_user32.TranslateMessage, wintypes.BOOL, ctypes.POINTER(wintypes.MSG))
+_declare(_user32.DispatchMessageW, ctypes.c_ssize_t, ctypes.POINTER(wintypes.MSG))
+_declare(_user32.SendInput, wintypes.UINT,
+         wintypes.UINT, ctypes.c_void_p, ctypes.c_int)
+_declare(_kernel32.OpenProcess, wintypes.HANDLE,
+         wintypes.DWORD, wintypes.BOOL, wintypes.DWORD)
+_declare(_kernel32.CloseHandle, wintypes.BOOL, wintypes.HANDLE)
+_declare(_kernel32.QueryFullProcessImageNameW, wintypes.BOOL,
+         wintypes.HANDLE, wintypes.DWORD, wintypes.LPWSTR, wintypes.LPDWORD)
+_declare(_dwmapi.DwmGetWindowAttribute, ctypes.c_long,
+         wintypes.HWND, wintypes.DWORD, ctypes.c_void_p, wintypes.DWORD)
+
+def iter_top_windows():
+    """Сырые hwnd всех топ-окон одним EnumWindows — микросекунды на окно
+    против UIA-обёртки с COM-вызовами на каждое."""
+    out = []
+
+    def _proc(hwnd, lparam):
+        out.append(hwnd)
+        return True
+
+    _user32.EnumWindows(_WndEnumProc(_proc), 0)
+    return out
+
+_WM_GETTEXT = 0x000D
+_SMTO_ABORTIFHUNG = 0x0002
+
+def _window_title(hwnd) -> str:
+    """Заголовок через SendMessageTimeoutW: зависшее окно не держит нас
+    дольше 100мс (GetWindowTextW на чужом окне блокируется навсегда)."""
+    buf = ctypes.create_unicode_buffer(256)
+    res = ctypes.c_void_p()
+    ok = _user32.SendMessageTimeoutW(hwnd, _WM_GETTEXT, 256, buf,
+                                     _SMTO_ABORTIFHUNG, 100, ctypes.byref(res))
+    return buf.value if ok else ""
+
+# Desktop(backend="uia") инициализирует COM и корень UIA — делаем это один
+# раз на процесс, а не в каждом вызове/потоке
+_desk = None
+_desk_lock = threading.Lock()
+
+def _get_desk() -> Desktop:
+    global _desk
+    if _desk is None:
+        with _desk_lock:
+            if _desk is None:
+                _desk = Desktop(backend="uia")
+    return _desk
+
+# штатные паузы pywinauto не нужны: строки шлём пачкой, клики — сообщениями
+Timings.after_sendkeys_key_wait = 0
+Timings.after_clickinput_wait = 0
+
+# символы, которые send_keys трактует как управляющие
+_SENDKEYS_META = "+^%~(){}"
+
+# с этой длины строку быстрее вставить через буфер обмена, чем печатать
+_PASTE_THRESHOLD = 32
+
+def _set_clipboard_text(text):
+    win32clipboard.OpenClipboard()
+    try:
+        win32clipboard.EmptyClipboard()
+        if text is not None:
+            win32clipboard.SetClipboardData(win32clipboard.CF_UNICODETEXT, text)
+    finally:
+        win32clipboard.CloseClipboard()
+
+def paste_text(text: str):
+    """Вставить текст одним Ctrl+V: весь буфер уходит одним сообщением,
+    сколько бы ни было символов. Старое содержимое буфера возвращаем."""
+    win32clipboard.OpenClipboard()
+    try:
+        old = win32clipboard.GetClipboardData(win32clipboard.CF_UNICODETEXT)
+    except (TypeError, win32clipboard.error):
+        old = None  # буфер пуст или не текст — восстанавливать нечего
+    finally:
+        win32clipboard.CloseClipboard()
+    _set_clipboard_text(text)
+    send_keys("^v", pause=0)
+    time.sleep(0.05)  # дать целевому окну забрать данные до восстановления
+    _set_clipboard_text(old)
+
+# pid → (имя exe, ts); pid стабилен в рамках одного ожидания окна, но Windows
+# агрессивно переиспользует pid'ы завершившихся процессов, поэтому запись
+# живёт недолго — иначе focus_by_exe мог бы сфокусировать чужое окно
+_PID_CACHE_TTL = 5.0
+_pid_exe_cache = {}
+
+def _exe_for_pid(pid: int) -> str:
+    """Имя exe по pid одним QueryFullProcessImageNameW — без перечисления
+    всех модулей процесса, как это делают psutil/pywinauto."""
+    cached = _pid_exe_cache.get(pid)
+    if cached is not None and time.monotonic() - cached[1] < _PID_CACHE_TTL:
+        return cached[0]
+    name = ""
+    h = _kernel32.OpenProcess(_PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+    if h:
+        try:
+            buf = ctypes.create_unicode_buffer(260)
+            size = wintypes.DWORD(len(buf))
+            if _kernel32.QueryFullProcessImageNameW(h, 0, buf, ctypes.byref(size)):
+                name = buf.value.rsplit("\\", 1)[-1].lower()
+        finally:
+            _kernel32.CloseHandle(h)
+    if not name:
+        # процессы с урезанными правами — через psutil
+        try:
+            name = psutil.Process(pid).name().lower()
+        except psutil.Error as exc:
+            log.debug("exe lookup failed for pid %s: %s", pid, exc)
+            return ""
+    now = time.monotonic()
+    if len(_pid_exe_cache) > 256:
+        # в длинной сессии не копим мёртвые pid'ы — выкидываем протухшие
+        for k in [k for k, (_, ts) in _pid_exe_cache.items()
+                  if now - ts >= _PID_CACHE_TTL]:
+            del _pid_exe_cache[k]
+    _pid_exe_cache[pid] = (name, now)
+    return name
+
+def _is_interactable(hwnd) -> bool:
+    """Окно видимо и не «cloaked» (скрытые UWP-хосты, заглушки шелла) —
+    одна дешёвая проверка отсекает большинство окон до любой работы."""
+    if not hwnd or not _user32.IsWindowVisible(hwnd):
+        return False
+    cloaked = ctypes.c_int(0)
+    try:
+        _dwmapi.DwmGetWindowAttribute(hwnd, _DWMWA_CLOAKED,
+                                      ctypes.byref(cloaked), 4)
+    except OSError:
+        return True  # DWM недоступен (старые системы) — считаем окно живым
+    return not cloaked.value
+
+def _hwnd_matches(hwnd, exe_substr: str) -> bool:
+    pid = wintypes.DWORD()
+    _user32.GetWindowThreadProcessId(hwnd, ctypes.byref(pid))
+    return bool(pid.value) and exe_substr in _exe_for_pid(pid.value)
+
+def _focus_hwnd(hwnd) -> bool:
+    try:
+        _user32.ShowWindow(hwnd, 9)  # SW_RESTORE — вдруг свернуто
+        return bool(_user32.SetForegroundWindow(hwnd))
+    except OSError as exc:
+        log.debug("focus failed for hwnd %s: %s", hwnd, exc)
+        return False
+
+# последний найденный hwnd по подстроке exe — следующий вызов начинает с него
+_last_hwnd = {}
 
 def focus_by_exe(exe_substr: str, timeout=20):
-    desk = Desktop(backend="uia")
-    t0 = time.time()
     exe_substr = exe_substr.lower()
-    while time.time() - t0 < timeout:
-        for w in desk.windows():
-            try:
-                pid = w.process_id()
-                name = w.element_info.process_id  # dummy touch
-                proc_name = w.app.process
-            except:
-                pass
-        for w in desk.windows():
-            try:
-                if exe_substr in (w.app.process_module or "").lower():
-                    w.set_focus()
-                    return True
-            except:
-                pass
-        time.sleep(0.5)
-    return False
-
-def type_text(text: str, delay: float = 0.03):
-    for ch in text:
-        send_keys(ch)
-        time.sleep(delay)
-    time.sleep(0.05)
+
+    # O(1)-пути: целевое окно уже в фокусе, либо мы его недавно находили
+    fg = _user32.GetForegroundWindow()
+    if fg and _hwnd_matches(fg, exe_substr):
+        return True
+    cached = _last_hwnd.get(exe_substr)
+    if cached and _user32.IsWindow(cached) and _is_interactable(cached) \
+            and _hwnd_matches(cached, exe_substr):
+        return _focus_hwnd(cached)
+
+    # не опрашиваем: WinEvent-хук разбудит при создании/показе/активации;
+    # SHOW нужен отдельно — окно, созданное скрытым и показанное позже,
+    # CREATE/FOREGROUND не даёт
+    found = {}
+
+    def _cb(hook, event, hwnd, obj_id, child_id, thread_id, ts):
+        if obj_id != _OBJID_WINDOW or not hwnd:
+            return
+        if "hwnd" not in found and _hwnd_matches(hwnd, exe_substr):
+            found["hwnd"] = hwnd
+
+    proc = _WinEventProc(_cb)
+    # хуки ставим ДО прохода по существующим окнам: окно, появившееся между
+    # сканом и установкой хука, иначе терялось бы до самого таймаута
+    hooks = [_user32.SetWinEventHook(ev, ev, 0, proc, 0, 0, _WINEVENT_OUTOFCONTEXT)
+             for ev in (_EVENT_SYSTEM_FOREGROUND, _EVENT_OBJECT_CREATE,
+                        _EVENT_OBJECT_SHOW)]
+    # perf_counter: монотонный и точный, time.time() на Windows шагает по ~16мс
+    # и может прыгнуть назад при синхронизации часов
+    deadline = time.perf_counter() + timeout
+
+    if not any(hooks):
+        # хук поставить не удалось — опрос, но с растущим интервалом:
+        # быстрые запуски ловим за ~50мс, долгие не жгут CPU
+        iv = 0.05
+        while True:
+            for hwnd in iter_top_windows():
+                if _is_interactable(hwnd) and _hwnd_matches(hwnd, exe_substr):
+                    _last_hwnd[exe_substr] = hwnd
+                    return _focus_hwnd(hwnd)
+            if time.perf_counter() >= deadline:
+                return False
+            time.sleep(iv)
+            iv = min(iv * 1.5, 0.5)
+
+    try:
+        # окно могло появиться до нас — один проход по существующим hwnd,
+        # уже под хуками, так что дырки между сканом и ожиданием нет
+        for hwnd in iter_top_windows():
+            if _is_interactable(hwnd) and _hwnd_matches(hwnd, exe_substr):
+                _last_hwnd[exe_substr] = hwnd
+                return _focus_hwnd(hwnd)
+
+        msg = wintypes.MSG()
+        while "hwnd" not in found:
+            left = deadline - time.perf_counter()
+            if left <= 0:
+                return False
+            # ждём сообщений (OUTOFCONTEXT-колбэк приходит через очередь)
+            _user32.MsgWaitForMultipleObjects(0, None, False,
+                                              int(left * 1000), _QS_ALLINPUT)
+            while _user32.PeekMessageW(ctypes.byref(msg), 0, 0, 0, _PM_REMOVE):
+                _user32.TranslateMessage(ctypes.byref(msg))
+                _user32.DispatchMessageW(ctypes.byref(msg))
+        _last_hwnd[exe_substr] = found["hwnd"]
+        return _focus_hwnd(found["hwnd"])
+    finally:
+        for h in hooks:
+            if h:
+                _user32.UnhookWinEvent(h)
+
+# SendInput с KEYEVENTF_UNICODE: шлём сам код символа, без раскладки,
+# виртуальных клавиш и DSL send_keys
+_INPUT_KEYBOARD = 1
+_KEYEVENTF_KEYUP = 0x0002
+_KEYEVENTF_UNICODE = 0x0004
+_ULONG_PTR = ctypes.c_size_t
+
+class _KEYBDINPUT(ctypes.Structure):
+    _fields_ = [("wVk", wintypes.WORD), ("wScan", wintypes.WORD),
+                ("dwFlags", wintypes.DWORD), ("time", wintypes.DWORD),
+                ("dwExtraInfo", _ULONG_PTR)]
+
+class _MOUSEINPUT(ctypes.Structure):
+    # не используем, но нужен для правильного sizeof(INPUT)
+    _fields_ = [("dx", wintypes.LONG), ("dy", wintypes.LONG),
+                ("mouseData", wintypes.DWORD), ("dwFlags", wintypes.DWORD),
+                ("time", wintypes.DWORD), ("dwExtraInfo", _ULONG_PTR)]
+
+class _INPUT(ctypes.Structure):
+    class _U(ctypes.Union):
+        _fields_ = [("ki", _KEYBDINPUT), ("mi", _MOUSEINPUT)]
+    _anonymous_ = ("u",)
+    _fields_ = [("type", wintypes.DWORD), ("u", _U)]
+
+def type_text_fast(text: str):
+    """Вся строка одним вызовом SendInput: один переход в ядро вместо
+    пары на каждый символ, любой Юникод, без экранирования метасимволов."""
+    units = text.replace("\n", "\r").encode("utf-16-le")
+    n = len(units) // 2
+    arr = (_INPUT * (2 * n))()
+    for i in range(n):
+        scan = units[2 * i] | (units[2 * i + 1] << 8)
+        down, up = arr[2 * i], arr[2 * i + 1]
+        down.type = up.type = _INPUT_KEYBOARD
+        down.ki.wScan = up.ki.wScan = scan
+        down.ki.dwFlags = _KEYEVENTF_UNICODE
+        up.ki.dwFlags = _KEYEVENTF_UNICODE | _KEYEVENTF_KEYUP
+    _user32.SendInput(2 * n, arr, ctypes.sizeof(_INPUT))
+
+def type_text(text: str, delay: float = 0.0):
+    # длинные «обычные» строки дешевле вставить из буфера одним Ctrl+V
+    if delay == 0 and len(text) >= _PASTE_THRESHOLD \
+            and not any(ch in _SENDKEYS_META for ch in text):
+        return paste_text(text)
+    if delay == 0:
+        return type_text_fast(text)
+    # delay > 0 оставлен как запасной режим для медленных легаси-окон
+    escaped = "".join("{" + ch + "}" if ch in _SENDKEYS_META else ch for ch in text)
+    send_keys(escaped, pause=delay, with_spaces=True, with_newlines=True)
 
 def press_enter():
     send_keys("{ENTER}")
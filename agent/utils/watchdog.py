@@ -1,34 +1,143 @@
 # agent/utils/watchdog.py
 # -*- coding: utf-8 -*-
+import ctypes
+import logging
+import re
 import time, threading
-from pywinauto import Desktop
+from ctypes import wintypes
+
 from pywinauto.keyboard import send_keys
 
+from .ui import _user32, _WinEventProc, _declare, _is_interactable, \
+    _window_title, iter_top_windows, _EVENT_OBJECT_CREATE, \
+    _WINEVENT_OUTOFCONTEXT, _OBJID_WINDOW, _QS_ALLINPUT, _PM_REMOVE
+
+log = logging.getLogger(__name__)
+
+_WINEVENT_SKIPOWNPROCESS = 0x0002
+_GA_ROOT = 2
+_BM_CLICK = 0x00F5
+
+_EnumChildProc = ctypes.WINFUNCTYPE(wintypes.BOOL, wintypes.HWND, wintypes.LPARAM)
+
+# прототипы функций, которые нужны только сторожу (остальные — в ui)
+_declare(_user32.GetAncestor, wintypes.HWND, wintypes.HWND, wintypes.UINT)
+_declare(_user32.EnumChildWindows, wintypes.BOOL,
+         wintypes.HWND, _EnumChildProc, wintypes.LPARAM)
+_declare(_user32.GetClassNameW, ctypes.c_int,
+         wintypes.HWND, wintypes.LPWSTR, ctypes.c_int)
+_declare(_user32.GetWindowTextW, ctypes.c_int,
+         wintypes.HWND, wintypes.LPWSTR, ctypes.c_int)
+_declare(_user32.PostMessageW, wintypes.BOOL,
+         wintypes.HWND, wintypes.UINT, wintypes.WPARAM, wintypes.LPARAM)
+
 KEYWORDS = ["error", "ошибка", "warning", "license", "update", "доверяете", "save", "сохранить"]
+# один regex-проход по заголовку вместо 8 поисков подстроки на окно
+_KW_RE = re.compile("|".join(re.escape(k) for k in KEYWORDS), re.IGNORECASE)
+
+# страховочный полный проход по окнам (на случай пропущенного события)
+_FULL_SCAN_SEC = 5.0
 
-def _try_close(win):
-    title = (win.window_text() or "").lower()
-    if any(k in title for k in KEYWORDS):
-        for label in ["OK","Yes","Да","ОК","Close","Закрыть","Cancel","Отмена"]:
-            try:
-                btn = win.child_window(title=label, control_type="Button")
-                if btn.exists(): btn.click_input(); return True
-            except: pass
+# диалог может закрываться дольше тика — столько не трогаем уже обработанный hwnd
+_RECENT_TTL = 3.0
+
+# подходящие подписи кнопок (без акселераторов и регистра)
+_LABELS = frozenset(l.lower() for l in
+                    ["OK", "Yes", "Да", "ОК", "Close", "Закрыть", "Cancel", "Отмена"])
+
+def _click_dialog_button(hwnd) -> bool:
+    """Один проход EnumChildWindows по Win32-дереву вместо UIA-запроса на
+    каждую подпись; нажатие — BM_CLICK прямо в wndproc кнопки."""
+    clicked = []
+
+    def _proc(child, lparam):
+        buf = ctypes.create_unicode_buffer(64)
+        _user32.GetClassNameW(child, buf, 64)
+        if "button" not in buf.value.lower():
+            return True
+        _user32.GetWindowTextW(child, buf, 64)
+        if buf.value.replace("&", "").strip().lower() in _LABELS:
+            _user32.PostMessageW(child, _BM_CLICK, 0, 0)
+            clicked.append(child)
+            return False  # нашли — дальше не перечисляем
+        return True
+
+    _user32.EnumChildWindows(hwnd, _EnumChildProc(_proc), 0)
+    return bool(clicked)
+
+def _try_close(hwnd) -> bool:
+    title = _window_title(hwnd)
+    if not title:  # безымянные окна (и зависшие с таймаутом) пропускаем сразу
+        return False
+    if _KW_RE.search(title):
+        if _click_dialog_button(hwnd):
+            return True
         send_keys("{ESC}"); return True
     return False
 
 def start_watchdog(stop_event, reporter=print):
     def loop():
-        desk = Desktop(backend="uia")
-        while not stop_event.is_set():
-            try:
-                for w in desk.windows():
+        pending = []  # hwnd'ы только что созданных топ-окон — из колбэка
+
+        def _cb(hook, event, hwnd, obj_id, child_id, thread_id, ts):
+            if obj_id != _OBJID_WINDOW or not hwnd:
+                return
+            # интересны только видимые (и не cloaked) топ-уровневые окна
+            if _user32.GetAncestor(hwnd, _GA_ROOT) != hwnd:
+                return
+            if not _is_interactable(hwnd):
+                return
+            pending.append(hwnd)
+
+        proc = _WinEventProc(_cb)
+        hook = _user32.SetWinEventHook(
+            _EVENT_OBJECT_CREATE, _EVENT_OBJECT_CREATE, 0, proc, 0, 0,
+            _WINEVENT_OUTOFCONTEXT | _WINEVENT_SKIPOWNPROCESS)
+        msg = wintypes.MSG()
+        last_full = 0.0
+        recent = {}  # hwnd -> monotonic-время последней попытки закрытия
+        try:
+            while not stop_event.is_set():
+                # спим до события от хука; просыпаемся сами только к сроку
+                # страховочного прохода (до 5с), а не каждые полсекунды
+                wait_ms = int(max(0.0, last_full + _FULL_SCAN_SEC - time.time()) * 1000)
+                _user32.MsgWaitForMultipleObjects(0, None, False,
+                                                  min(wait_ms, 5000) or 1, _QS_ALLINPUT)
+                while _user32.PeekMessageW(ctypes.byref(msg), 0, 0, 0, _PM_REMOVE):
+                    _user32.TranslateMessage(ctypes.byref(msg))
+                    _user32.DispatchMessageW(ctypes.byref(msg))
+                # уже обработанные, но ещё не успевшие закрыться — не трогаем
+                now = time.monotonic()
+                for h in [h for h, ts in recent.items() if now - ts > _RECENT_TTL]:
+                    del recent[h]
+                # O(1): проверяем только свежесозданные окна
+                while pending:
+                    hwnd = pending.pop()
+                    if hwnd in recent:
+                        continue
                     try:
-                        if _try_close(w):
-                            reporter(f"[watchdog] Закрыт диалог: {w.window_text()!r}")
-                    except: pass
-            except: pass
-            time.sleep(0.5)
+                        title = _window_title(hwnd)
+                        if _try_close(hwnd):
+                            recent[hwnd] = time.monotonic()
+                            reporter(f"[watchdog] Закрыт диалог: {title!r}")
+                    except (OSError, RuntimeError) as exc:
+                        log.debug("close attempt failed for hwnd %s: %s", hwnd, exc)
+                # и изредка — полный проход на случай пропущенного события
+                if time.time() - last_full >= _FULL_SCAN_SEC:
+                    last_full = time.time()
+                    for hwnd in iter_top_windows():
+                        try:
+                            if hwnd in recent or not _is_interactable(hwnd):
+                                continue
+                            title = _window_title(hwnd)
+                            if _try_close(hwnd):
+                                recent[hwnd] = time.monotonic()
+                                reporter(f"[watchdog] Закрыт диалог: {title!r}")
+                        except (OSError, RuntimeError) as exc:
+                            log.debug("close attempt failed for hwnd %s: %s", hwnd, exc)
+        finally:
+            if hook:
+                _user32.UnhookWinEvent(hook)
     t = threading.Thread(target=loop, daemon=True)
     t.start()
     return t